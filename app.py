@@ -1,10 +1,15 @@
 import subprocess
+import signal
+import socket
 import sys
 import os
+import threading
 import time
 import logging
+import urllib.request
 import shutil
 from pathlib import Path
+import uvicorn
 
 # Configure logging
 logging.basicConfig(
@@ -13,14 +18,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds to wait for /health to report the model loaded; covers the model
+# download, torch.compile warmup and CUDA memory reservation in the lifespan
+STARTUP_TIMEOUT = int(os.environ.get("BACKEND_STARTUP_TIMEOUT", "900"))
+
+# Seconds to wait for uvicorn to finish the app's lifespan shutdown on exit
+SHUTDOWN_TIMEOUT = 30
+
 def setup_model_directory():
     """Set up the model directory with a fallback model if needed"""
     try:
         app_root = Path(__file__).parent.absolute()
         model_path = app_root / "backend" / "finetuned_model"
         
-        # Check if model directory exists and has required files
-        if not model_path.exists() or not (model_path / "config.json").exists():
+        # Check if model directory holds a full model or a LoRA adapter from train.py
+        has_model = (model_path / "config.json").exists() or (model_path / "adapter_config.json").exists()
+        if not has_model:
             logger.info("Model files not found, using fallback model: microsoft/DialoGPT-small")
             # Set environment variable to use the fallback model
             os.environ["USE_FALLBACK_MODEL"] = "true"
@@ -36,65 +49,104 @@ def setup_model_directory():
         logger.error(f"Traceback: {traceback.format_exc()}")
         sys.exit(1)
 
-def run_backend():
-    """Start the FastAPI backend server"""
+def wait_for_port(is_alive, port, timeout):
+    """Poll until something accepts TCP connections on the given local port.
+
+    Returns True once the port is bound, False if is_alive() turns false or
+    the timeout expires first.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not is_alive():
+            return False
+        with socket.socket() as s:
+            s.settimeout(0.2)
+            try:
+                s.connect(("127.0.0.1", port))
+                return True
+            except OSError:
+                time.sleep(0.05)
+    return False
+
+def wait_for_health(is_alive, url, timeout):
+    """Poll a health endpoint until it answers 200.
+
+    Returns True once it does, False if is_alive() turns false or the
+    timeout expires first.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not is_alive():
+            return False
+        try:
+            with urllib.request.urlopen(url, timeout=0.5) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+def run_backend(wakeup_fd):
+    """Start the FastAPI backend server in a background thread"""
     try:
         logger.info("Starting FastAPI backend server...")
         # Get absolute paths
         app_root = Path(__file__).parent.absolute()
         backend_path = app_root / "backend"
         
-        # Add backend directory to Python path
-        if str(backend_path) not in sys.path:
-            sys.path.insert(0, str(backend_path))
-        
-        # Log the Python path for debugging
-        logger.info(f"Python path: {sys.path}")
+        # Log the paths for debugging
         logger.info(f"Current working directory: {os.getcwd()}")
         logger.info(f"Backend path: {backend_path}")
         
         # List backend directory contents for debugging
         logger.info(f"Backend directory contents: {os.listdir(backend_path)}")
             
-        # Start the backend server with output capture
-        backend_process = subprocess.Popen(
-            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "0.0.0.0", "--port", "8000"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=str(backend_path),
-            text=True,
-            bufsize=1,
-            universal_newlines=True,
-            env={**os.environ, "PYTHONPATH": f"{str(backend_path)}:{os.environ.get('PYTHONPATH', '')}"}
-        )
+        # Serve the backend from this process instead of spawning a second
+        # interpreter for uvicorn. The working directory stays as it is, so
+        # point the backend's data paths at backend/ explicitly, as MODEL_PATH is
+        os.environ.setdefault("VECTOR_DB_PATH", str(backend_path / "vector_store"))
+        # What uvicorn.run(app_dir=...) does; uvicorn 0.24's Config has no app_dir
+        if str(backend_path) not in sys.path:
+            sys.path.insert(0, str(backend_path))
+        server = uvicorn.Server(uvicorn.Config(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            loop="uvloop",
+            http="httptools"
+        ))
         
-        # Monitor the startup
-        start_time = time.time()
-        while time.time() - start_time < 30:  # Increased timeout to 30 seconds
-            if backend_process.poll() is not None:
-                # Process died, get the error message
-                stdout, stderr = backend_process.communicate()
-                logger.error(f"Backend server failed to start")
-                logger.error(f"Stdout: {stdout}")
-                logger.error(f"Stderr: {stderr}")
-                sys.exit(1)
-                
-            # Check stdout/stderr for startup progress
-            stderr = backend_process.stderr.readline()
-            if stderr:
-                logger.info(f"Backend startup: {stderr.strip()}")
-            
-            stdout = backend_process.stdout.readline()
-            if stdout:
-                logger.info(f"Backend startup: {stdout.strip()}")
-                if "Application startup complete" in stdout:
-                    logger.info("Backend server started successfully")
-                    return backend_process
-                
-            time.sleep(0.1)
-            
+        backend_stopped = threading.Event()
+        
+        def serve():
+            try:
+                server.run()
+            finally:
+                # Flag the exit, then wake the supervisor loop in main()
+                backend_stopped.set()
+                os.write(wakeup_fd, b"\0")
+        
+        threading.Thread(target=serve, name="uvicorn", daemon=True).start()
+        
+        # Wait for the backend to report the model as loaded; a Ctrl+C or
+        # SIGTERM meanwhile still runs the lifespan shutdown before exiting
+        is_alive = lambda: not backend_stopped.is_set()
+        try:
+            healthy = wait_for_health(is_alive, "http://127.0.0.1:8000/health", timeout=STARTUP_TIMEOUT)
+        except KeyboardInterrupt:
+            stop_backend(server, backend_stopped)
+            raise
+        if healthy:
+            logger.info("Backend server started successfully")
+            return server, backend_stopped
+
+        if backend_stopped.is_set():
+            logger.error("Backend server failed to start")
+            sys.exit(1)
+
         logger.error("Backend server startup timed out")
-        backend_process.terminate()
+        stop_backend(server, backend_stopped)
         sys.exit(1)
         
     except Exception as e:
@@ -103,6 +155,12 @@ def run_backend():
         logger.error(f"Traceback: {traceback.format_exc()}")
         sys.exit(1)
 
+def stop_backend(server, backend_stopped):
+    """Ask uvicorn to exit and wait for its lifespan shutdown to finish"""
+    server.should_exit = True
+    if not backend_stopped.wait(timeout=SHUTDOWN_TIMEOUT):
+        logger.warning("Backend server did not shut down in time")
+
 def run_nginx():
     """Start the Nginx server"""
     try:
@@ -110,32 +168,21 @@ def run_nginx():
         # Start Nginx without sudo (since we already set permissions in Dockerfile)
         nginx_process = subprocess.Popen(
             ["nginx", "-g", "daemon off;"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
+            stdout=sys.stdout,
+            stderr=sys.stderr
         )
         
-        # Monitor the startup
-        start_time = time.time()
-        while time.time() - start_time < 5:  # Wait up to 5 seconds
-            if nginx_process.poll() is not None:
-                # Process died, get the error message
-                stdout, stderr = nginx_process.communicate()
-                logger.error(f"Nginx server failed to start")
-                logger.error(f"Stdout: {stdout}")
-                logger.error(f"Stderr: {stderr}")
-                sys.exit(1)
-                
-            # Check stderr for any errors
-            stderr = nginx_process.stderr.readline()
-            if stderr:
-                logger.error(f"Nginx startup error: {stderr.strip()}")
+        # Wait for Nginx to bind its port
+        try:
+            started = wait_for_port(lambda: nginx_process.poll() is None, 7860, timeout=5)
+        except KeyboardInterrupt:
+            nginx_process.terminate()
+            raise
+        if not started:
+            if nginx_process.poll() is None:
                 nginx_process.terminate()
-                sys.exit(1)
-                
-            time.sleep(0.1)
+            logger.error(f"Nginx server failed to start (exit code {nginx_process.wait()})")
+            sys.exit(1)
             
         logger.info("Nginx server started successfully")
         return nginx_process
@@ -162,38 +209,46 @@ def main():
         logger.info(f"PYTHONPATH: {os.environ.get('PYTHONPATH')}")
         logger.info(f"Current directory: {os.getcwd()}")
         
-        # Start backend server
-        backend_process = run_backend()
-        
-        # Start Nginx server
-        nginx_process = run_nginx()
+        # Wake the supervisor loop only when a child process exits or the
+        # backend thread stops: the interpreter writes a byte to the wakeup
+        # pipe for every signal, and the backend thread writes one on exit.
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # Treat SIGTERM (docker stop) like Ctrl+C so the backend shuts down gracefully
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
         
-        logger.info("All services started successfully")
-        
-        # Keep the main process running and monitor child processes
-        while True:
-            try:
-                time.sleep(1)
+        backend_server = nginx_process = None
+        try:
+            # Start backend server
+            backend_server, backend_stopped = run_backend(wakeup_w)
+            
+            # Start Nginx server
+            nginx_process = run_nginx()
+            
+            logger.info("All services started successfully")
+            
+            # Keep the main process running and monitor child processes
+            while True:
+                os.read(wakeup_r, 512)
                 # Check if any process has died
-                if backend_process.poll() is not None:
-                    stdout, stderr = backend_process.communicate()
-                    logger.error(f"Backend server died unexpectedly")
-                    logger.error(f"Stdout: {stdout}")
-                    logger.error(f"Stderr: {stderr}")
+                if backend_stopped.is_set():
+                    logger.error("Backend server died unexpectedly")
                     sys.exit(1)
                     
                 if nginx_process.poll() is not None:
-                    stdout, stderr = nginx_process.communicate()
-                    logger.error(f"Nginx server died unexpectedly")
-                    logger.error(f"Stdout: {stdout}")
-                    logger.error(f"Stderr: {stderr}")
+                    logger.error(f"Nginx server died unexpectedly (exit code {nginx_process.returncode})")
                     sys.exit(1)
                     
-            except KeyboardInterrupt:
-                logger.info("Shutting down services...")
-                backend_process.terminate()
+        except KeyboardInterrupt:
+            # Services interrupted mid-startup have already stopped themselves
+            logger.info("Shutting down services...")
+            if nginx_process is not None:
                 nginx_process.terminate()
-                sys.exit(0)
+            if backend_server is not None:
+                stop_backend(backend_server, backend_stopped)
+            sys.exit(0)
             
     except Exception as e:
         logger.error(f"Error in main process: {str(e)}")
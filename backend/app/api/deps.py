@@ -0,0 +1,15 @@
+from typing import Annotated, Any
+from fastapi import Depends, Request
+from app.core.auth import get_current_active_user, get_current_user
+from app.services.chat_service import ChatService
+from app.services.vector_store import VectorStore, get_vector_store
+
+def get_chat_service(request: Request) -> ChatService:
+    """Return the chat service the app lifespan loaded"""
+    return request.app.state.chat_service
+
+# Reusable dependency annotations for route signatures
+VectorStoreDep = Annotated[VectorStore, Depends(get_vector_store)]
+ChatServiceDep = Annotated[ChatService, Depends(get_chat_service)]
+CurrentUser = Annotated[Any, Depends(get_current_user)]
+ActiveUser = Annotated[Any, Depends(get_current_active_user)]
@@ -1,19 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from pydantic.dataclasses import dataclass
 from datetime import datetime
-from app.core.auth import get_current_user
-from app.services.chat_service import ChatService
-from app.services.vector_store import VectorStore
+from app.api.deps import ChatServiceDep, CurrentUser, VectorStoreDep
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra='ignore', from_attributes=True)
+
     content: str
     timestamp: Optional[datetime] = None
     context_id: Optional[str] = None
 
-class ChatResponse(BaseModel):
+# Built once per message and history entry, so use a slotted immutable dataclass
+@dataclass(frozen=True, slots=True, config=ConfigDict(extra='ignore', from_attributes=True))
+class ChatResponse:
     message: str
     timestamp: datetime
     context_used: Optional[List[str]] = None
@@ -21,9 +25,9 @@ class ChatResponse(BaseModel):
 @router.post("/message", response_model=ChatResponse)
 async def send_message(
     message: ChatMessage,
-    current_user = Depends(get_current_user),
-    chat_service: ChatService = Depends(),
-    vector_store: VectorStore = Depends()
+    current_user: CurrentUser,
+    chat_service: ChatServiceDep,
+    vector_store: VectorStoreDep
 ):
     """
     Process a chat message and return a response with relevant context
@@ -32,11 +36,11 @@ async def send_message(
         # Get relevant context from vector store
         context = await vector_store.get_relevant_context(message.content)
         
-        # Generate response using LLM with context
-        response = await chat_service.generate_response(
+        # Generate the reply with the retrieved context in its prompt
+        response = await chat_service.get_response(
             message.content,
-            context=context,
-            user_id=current_user.id
+            str(current_user.id),
+            context=context
         )
         
         return ChatResponse(
@@ -53,8 +57,8 @@ async def send_message(
 
 @router.get("/history", response_model=List[ChatResponse])
 async def get_chat_history(
-    current_user = Depends(get_current_user),
-    chat_service: ChatService = Depends(),
+    current_user: CurrentUser,
+    chat_service: ChatServiceDep,
     limit: int = 50,
     before: Optional[datetime] = None
 ):
@@ -78,8 +82,8 @@ async def get_chat_history(
 async def upload_context(
     content: str,
     source: str,
-    current_user = Depends(get_current_user),
-    vector_store: VectorStore = Depends()
+    current_user: CurrentUser,
+    vector_store: VectorStoreDep
 ):
     """
     Upload new context to the vector store
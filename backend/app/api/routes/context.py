@@ -1,44 +1,58 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from typing import List, Optional
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, UploadFile, File
+from fastapi.responses import ORJSONResponse
+from typing import Annotated, List, Optional
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from pydantic.dataclasses import dataclass
 from datetime import datetime
-from app.core.auth import get_current_active_user
-from app.services.vector_store import VectorStore
+from app.api.deps import ActiveUser, VectorStoreDep
 import json
+import ijson
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
+
+# Number of JSON array items embedded per add_documents call during upload
+UPLOAD_BATCH_SIZE = 128
 
 class Document(BaseModel):
+    model_config = ConfigDict(extra='ignore', from_attributes=True)
+
     id: int
     content: str
     source: str
     timestamp: datetime
 
 class DocumentCreate(BaseModel):
+    model_config = ConfigDict(extra='ignore', from_attributes=True)
+
     content: str
     source: str
 
-class DocumentResponse(BaseModel):
+# Built once per listed document, so use a slotted immutable dataclass
+@dataclass(frozen=True, slots=True, config=ConfigDict(extra='ignore', from_attributes=True))
+class DocumentResponse:
     id: int
     source: str
     timestamp: datetime
 
+# Built once at import instead of per list_documents call
+_DOC_LIST_ADAPTER = TypeAdapter(List[DocumentResponse])
+
 @router.post("/documents", response_model=DocumentResponse)
 async def create_document(
     document: DocumentCreate,
-    current_user = Depends(get_current_active_user),
-    vector_store: VectorStore = Depends()
+    current_user: ActiveUser,
+    vector_store: VectorStoreDep
 ):
     """
     Add a new document to the context store
     """
     try:
-        await vector_store.add_document(
+        doc_id = await vector_store.add_document(
             content=document.content,
             source=document.source
         )
         return DocumentResponse(
-            id=len(vector_store.metadata) - 1,
+            id=doc_id,
             source=document.source,
             timestamp=datetime.utcnow()
         )
@@ -50,8 +64,8 @@ async def create_document(
 
 @router.get("/documents", response_model=List[DocumentResponse])
 async def list_documents(
-    current_user = Depends(get_current_active_user),
-    vector_store: VectorStore = Depends(),
+    current_user: ActiveUser,
+    vector_store: VectorStoreDep,
     skip: int = 0,
     limit: int = 10
 ):
@@ -59,15 +73,8 @@ async def list_documents(
     List all documents in the context store
     """
     try:
-        documents = vector_store.metadata[skip:skip + limit]
-        return [
-            DocumentResponse(
-                id=doc["id"],
-                source=doc["source"],
-                timestamp=datetime.fromisoformat(doc["timestamp"])
-            )
-            for doc in documents
-        ]
+        documents = vector_store.metadata.values()[skip:skip + limit]
+        return _DOC_LIST_ADAPTER.validate_python(documents)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -77,8 +84,8 @@ async def list_documents(
 @router.delete("/documents/{document_id}")
 async def delete_document(
     document_id: int,
-    current_user = Depends(get_current_active_user),
-    vector_store: VectorStore = Depends()
+    current_user: ActiveUser,
+    vector_store: VectorStoreDep
 ):
     """
     Delete a document from the context store
@@ -94,51 +101,65 @@ async def delete_document(
 
 @router.post("/documents/upload")
 async def upload_document(
-    file: UploadFile = File(...),
-    current_user = Depends(get_current_active_user),
-    vector_store: VectorStore = Depends()
+    file: Annotated[UploadFile, File()],
+    current_user: ActiveUser,
+    vector_store: VectorStoreDep
 ):
     """
     Upload a document file to the context store
+
+    JSON arrays are stored in batches while they stream in, so a failure
+    partway through keeps the items stored before it; the error reports
+    how many were added.
     """
+    added = 0
     try:
-        content = await file.read()
-        content_str = content.decode("utf-8")
-        
         # Parse content based on file type
         if file.filename.endswith('.json'):
-            data = json.loads(content_str)
-            # Handle different JSON structures
-            if isinstance(data, list):
-                for item in data:
-                    await vector_store.add_document(
-                        content=json.dumps(item),
-                        source=f"{file.filename}:{item.get('id', 'unknown')}"
-                    )
+            # Peek at the payload to see whether it is a JSON array
+            head = (await file.read(1024)).lstrip()
+            await file.seek(0)
+            
+            if head.startswith(b"["):
+                # Stream array items so only one batch is held in memory
+                contents, sources = [], []
+                async for item in ijson.items_async(file, "item", use_float=True):
+                    contents.append(json.dumps(item))
+                    sources.append(f"{file.filename}:{item.get('id', 'unknown')}")
+                    if len(contents) >= UPLOAD_BATCH_SIZE:
+                        added += len(await vector_store.add_documents(contents, sources))
+                        contents, sources = [], []
+                added += len(await vector_store.add_documents(contents, sources))
             else:
+                # Validate the payload before storing it as a single document
+                content_str = (await file.read()).decode("utf-8")
+                json.loads(content_str)
                 await vector_store.add_document(
                     content=content_str,
                     source=file.filename
                 )
+                added = 1
         else:
             # Handle plain text files
+            content_str = (await file.read()).decode("utf-8")
             await vector_store.add_document(
                 content=content_str,
                 source=file.filename
             )
+            added = 1
         
-        return {"message": "Document uploaded successfully"}
+        return {"message": "Document uploaded successfully", "documents_added": added}
     except Exception as e:
         raise HTTPException(
             status_code=500,
-            detail=f"Error uploading document: {str(e)}"
+            detail=f"Error uploading document: {str(e)} ({added} documents added before the error)"
         )
 
 @router.get("/search")
 async def search_context(
     query: str,
-    current_user = Depends(get_current_active_user),
-    vector_store: VectorStore = Depends(),
+    current_user: ActiveUser,
+    vector_store: VectorStoreDep,
     limit: int = 5
 ):
     """
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 from typing import Optional
 import os
@@ -31,4 +32,9 @@ class Settings(BaseSettings):
     class Config:
         case_sensitive = True
 
-settings = Settings() 
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Return the cached application settings"""
+    return Settings()
+
+settings = get_settings() 
\ No newline at end of file
@@ -1,57 +1,87 @@
-import socketio
-from typing import Dict, Any
+import asyncio
+import heapq
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+from uuid import uuid4
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from app.core.config import settings
 
-# Create Socket.IO server
-sio = socketio.AsyncServer(
-    async_mode='asgi',
-    cors_allowed_origins=['http://localhost:5173'],
-    logger=True,
-    engineio_logger=True
-)
+# WebSocket routes
+router = APIRouter()
 
 # Store active connections
-active_connections: Dict[str, Any] = {}
+active_connections: Dict[str, Dict[str, Any]] = {}
 
-@sio.event
-async def connect(sid, environ):
+# Min-heap of (expiry time, sid). Entries are pushed on every activity update
+# and are not removed when superseded; stale ones are skipped when popped.
+# Times are event-loop monotonic seconds, not wall-clock datetimes.
+expiry_heap: List[Tuple[float, str]] = []
+
+# Idle seconds after which a connection is dropped
+CONNECTION_TIMEOUT = settings.WS_HEARTBEAT_INTERVAL * 2
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """Accept a client and dispatch its messages until it disconnects"""
+    await websocket.accept()
+    sid = uuid4().hex
+    await connect(sid, websocket)
+    try:
+        while True:
+            data = await websocket.receive_json()
+            await chat_message(sid, data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await disconnect(sid)
+
+async def connect(sid: str, websocket: WebSocket):
     """Handle client connection"""
     print(f"Client connected: {sid}")
+    now = asyncio.get_running_loop().time()
     active_connections[sid] = {
-        "connected_at": datetime.utcnow(),
-        "last_activity": datetime.utcnow()
+        "websocket": websocket,
+        "connected_at": now,
+        "last_activity": now
     }
+    heapq.heappush(expiry_heap, (now + CONNECTION_TIMEOUT, sid))
 
-@sio.event
-async def disconnect(sid):
+async def disconnect(sid: str):
     """Handle client disconnection"""
     print(f"Client disconnected: {sid}")
     if sid in active_connections:
         del active_connections[sid]
 
-@sio.event
-async def chat_message(sid, data):
+async def chat_message(sid: str, data: Dict[str, Any]):
     """Handle incoming chat messages"""
+    connection = active_connections.get(sid)
+    if connection is None:
+        return
+    websocket = connection["websocket"]
+
     try:
         # Update last activity
-        if sid in active_connections:
-            active_connections[sid]["last_activity"] = datetime.utcnow()
-        
+        now = asyncio.get_running_loop().time()
+        connection["last_activity"] = now
+        heapq.heappush(expiry_heap, (now + CONNECTION_TIMEOUT, sid))
+
         # Process message and get response
         response = await process_chat_message(data)
-        
+
         # Send response back to client
-        await sio.emit('chat_response', {
+        await websocket.send_json({
+            'type': 'chat_response',
             'message': response,
             'timestamp': datetime.utcnow().isoformat()
-        }, room=sid)
-        
+        })
+
     except Exception as e:
         # Handle errors gracefully
-        await sio.emit('error', {
+        await websocket.send_json({
+            'type': 'error',
             'message': 'An error occurred while processing your message',
             'details': str(e)
-        }, room=sid)
+        })
 
 async def process_chat_message(data: Dict[str, Any]) -> str:
     """Process chat message and generate response"""
@@ -59,18 +89,28 @@ async def process_chat_message(data: Dict[str, Any]) -> str:
     # This will integrate with the LLM and vector database
     return "Message received and processed"
 
+async def expire_connections(current_time: float):
+    """Close and forget every connection idle for longer than CONNECTION_TIMEOUT"""
+    # Only look at entries whose expiry has passed
+    while expiry_heap and expiry_heap[0][0] < current_time:
+        _, sid = heapq.heappop(expiry_heap)
+        connection = active_connections.get(sid)
+        if connection is None:
+            continue
+        # Superseded by a later activity update
+        if current_time - connection["last_activity"] <= CONNECTION_TIMEOUT:
+            continue
+        active_connections.pop(sid, None)
+        try:
+            await connection["websocket"].close()
+        except Exception as e:
+            # Already dead on the client side; it is forgotten either way
+            print(f"Error closing expired connection {sid}: {e}")
+
 # Heartbeat mechanism
 async def check_connections():
     """Periodically check and clean up inactive connections"""
+    loop = asyncio.get_running_loop()
     while True:
-        current_time = datetime.utcnow()
-        inactive_sids = []
-        
-        for sid, connection in active_connections.items():
-            if (current_time - connection["last_activity"]).seconds > settings.WS_HEARTBEAT_INTERVAL * 2:
-                inactive_sids.append(sid)
-        
-        for sid in inactive_sids:
-            await sio.disconnect(sid)
-        
-        await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL) 
\ No newline at end of file
+        await expire_connections(loop.time())
+        await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL)
@@ -1,10 +1,31 @@
 import os
 import sys
+import platform
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, WebSocket, HTTPException
+
+# Let the CUDA caching allocator grow segments in place instead of fragmenting;
+# these must be set before torch is first imported
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:128"
+)
+
+# CPU inference: cap intra-op threads so a single decode doesn't oversubscribe
+# many-core hosts. The CPU path runs eager (torch.compile is CUDA-only), so
+# Inductor settings would have no effect here
+os.environ.setdefault("OMP_NUM_THREADS", str(min(8, os.cpu_count() or 1)))
+if platform.machine() == "aarch64":
+    # Graviton/Neoverse: allow ACL's bf16 fast-math matmul kernels
+    os.environ.setdefault("DNNL_DEFAULT_FPMATH_MODE", "BF16")
+
+from fastapi import FastAPI, Request, WebSocket, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.services.chat_service import ChatService
+from app.services.vector_store import get_vector_store
 from app.models.chat import ChatMessage
 
 # Configure logging
@@ -17,8 +38,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def log_startup_environment():
+    """Log environment and path information for debugging"""
+    # Log environment information
+    logger.info("Environment variables:")
+    logger.info(f"MODEL_PATH: {os.environ.get('MODEL_PATH')}")
+    logger.info(f"USE_FALLBACK_MODEL: {os.environ.get('USE_FALLBACK_MODEL')}")
+    logger.info(f"FALLBACK_MODEL: {os.environ.get('FALLBACK_MODEL')}")
+    logger.info(f"PYTHONPATH: {os.environ.get('PYTHONPATH')}")
+    
+    # Log directory information
+    current_dir = os.getcwd()
+    logger.info(f"Current directory: {current_dir}")
+    backend_path = str(Path(current_dir) / "backend")
+    logger.info(f"Backend path: {backend_path}")
+    
+    if os.path.exists(backend_path):
+        logger.info(f"Backend directory contents: {os.listdir(backend_path)}")
+    
+    logger.info("Starting FastAPI backend server...")
+    logger.info(f"Python path: {sys.path}")
+    logger.info(f"Current working directory: {os.getcwd()}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the chat model before the server starts accepting requests and release it on shutdown"""
+    try:
+        log_startup_environment()
+        
+        # Initialize chat service off the event loop
+        logger.info("Initializing chat service...")
+        app.state.chat_service = await asyncio.to_thread(ChatService)
+        logger.info("Chat service initialized successfully")
+    except Exception as e:
+        logger.error(f"Failed to initialize chat service: {str(e)}")
+        raise
+    yield
+    
+    # Stop the generation batcher and its worker thread, and the embedding
+    # batcher if any request created the vector store
+    await app.state.chat_service.close()
+    if get_vector_store.cache_info().currsize:
+        await get_vector_store().aclose()
+
 # Initialize FastAPI app
-app = FastAPI(title="Financial Chatbot API")
+app = FastAPI(
+    title="Financial Chatbot API",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # Configure CORS
 app.add_middleware(
@@ -29,46 +97,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize chat service
-try:
-    logger.info("Initializing chat service...")
-    chat_service = ChatService()
-    logger.info("Chat service initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize chat service: {str(e)}")
-    raise
-
-@app.on_event("startup")
-async def startup_event():
-    try:
-        # Log environment information
-        logger.info("Environment variables:")
-        logger.info(f"MODEL_PATH: {os.environ.get('MODEL_PATH')}")
-        logger.info(f"USE_FALLBACK_MODEL: {os.environ.get('USE_FALLBACK_MODEL')}")
-        logger.info(f"FALLBACK_MODEL: {os.environ.get('FALLBACK_MODEL')}")
-        logger.info(f"PYTHONPATH: {os.environ.get('PYTHONPATH')}")
-        
-        # Log directory information
-        current_dir = os.getcwd()
-        logger.info(f"Current directory: {current_dir}")
-        backend_path = str(Path(current_dir) / "backend")
-        logger.info(f"Backend path: {backend_path}")
-        
-        if os.path.exists(backend_path):
-            logger.info(f"Backend directory contents: {os.listdir(backend_path)}")
-        
-        logger.info("Starting FastAPI backend server...")
-        logger.info(f"Python path: {sys.path}")
-        logger.info(f"Current working directory: {os.getcwd()}")
-        
-    except Exception as e:
-        logger.error(f"Error during startup: {str(e)}")
-        raise
-
 @app.get("/health")
-async def health_check():
-    """Health check endpoint"""
+async def health_check(request: Request):
+    """Health check endpoint; reports ready only once the model is loaded"""
     try:
+        if getattr(request.app.state, "chat_service", None) is None:
+            return ORJSONResponse(
+                status_code=503,
+                content={"status": "starting", "model_loaded": False}
+            )
         return {"status": "healthy", "model_loaded": True}
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
@@ -91,7 +128,7 @@ async def websocket_endpoint(websocket: WebSocket):
                 logger.info(f"Received message from user {user_id}: {message[:50]}...")
                 
                 # Generate response
-                response = await chat_service.get_response(message, user_id)
+                response = await websocket.app.state.chat_service.get_response(message, user_id)
                 
                 # Send response
                 await websocket.send_json({"response": response})
@@ -109,10 +146,10 @@ async def websocket_endpoint(websocket: WebSocket):
             await websocket.close()
 
 @app.post("/chat")
-async def chat(message: ChatMessage):
+async def chat(message: ChatMessage, request: Request):
     """HTTP endpoint for chat (fallback for WebSocket)"""
     try:
-        response = await chat_service.get_response(message.message, message.user_id)
+        response = await request.app.state.chat_service.get_response(message.message, message.user_id)
         return {"response": response}
     except Exception as e:
         logger.error(f"Error processing chat message: {str(e)}")
@@ -0,0 +1,17 @@
+import asyncio
+from typing import Any, List
+
+async def collect_batch(queue: asyncio.Queue, max_size: int, max_wait: float) -> List[Any]:
+    """
+    Wait for one queued item, then keep taking items until max_size are
+    collected or max_wait seconds have passed since the first arrived
+    """
+    loop = asyncio.get_running_loop()
+    items = [await queue.get()]
+    deadline = loop.time() + max_wait
+    while len(items) < max_size and (remaining := deadline - loop.time()) > 0:
+        try:
+            items.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return items
@@ -1,14 +1,39 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
-import json
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from collections import deque
+from collections import OrderedDict, deque
 import os
+import tempfile
+from app.services.batching import collect_batch
 
 logger = logging.getLogger(__name__)
 
+# Prompts are left-padded to a multiple of this so batches share a handful
+# of shapes instead of one per prompt length
+PROMPT_BUCKET = 32
+
+# Largest generate() batch and how long the first queued prompt waits for company
+GENERATION_MAX_BATCH = int(os.environ.get("GENERATION_MAX_BATCH", "8"))
+GENERATION_BATCH_WAIT = 0.020
+
+# Most tokens of retrieved context added to a prompt, leaving room for the
+# history and the reply within max_length
+CONTEXT_MAX_TOKENS = 192
+
+# Sampling settings shared by the batched and cached generate() paths
+GENERATION_KWARGS = {
+    "max_length": 512,
+    "num_return_sequences": 1,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "do_sample": True,
+    "repetition_penalty": 1.2
+}
+
 class ChatService:
     def __init__(self):
         try:
@@ -16,6 +41,7 @@ class ChatService:
             use_fallback = os.environ.get("USE_FALLBACK_MODEL", "false").lower() == "true"
             fallback_model = os.environ.get("FALLBACK_MODEL", "microsoft/DialoGPT-small")
             model_path = os.environ.get("MODEL_PATH", "finetuned_model")
+            is_adapter = not use_fallback and os.path.exists(os.path.join(model_path, "adapter_config.json"))
 
             # Log device information
             logger.info(f"CUDA available: {torch.cuda.is_available()}")
@@ -25,18 +51,39 @@ class ChatService:
             # Set device
             device = "cuda" if torch.cuda.is_available() else "cpu"
             logger.info(f"Using device: {device}")
+            
+            # Match torch's CPU thread pools to OMP_NUM_THREADS; one inter-op thread
+            # since requests are already serialized on the generation thread
+            if device == "cpu":
+                torch.set_num_threads(int(os.environ.get("OMP_NUM_THREADS", torch.get_num_threads())))
+                try:
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    # Only settable once, before any inter-op work has started
+                    pass
+                logger.info(f"CPU threads: {torch.get_num_threads()}")
+            
+            # All model calls run on one dedicated thread, which serializes GPU work
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+            
+            # Half precision on GPU, full precision on CPU
+            if device == "cuda":
+                dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            else:
+                dtype = torch.float32
+            logger.info(f"Using dtype: {dtype}")
 
             if use_fallback:
                 logger.info(f"Using fallback model: {fallback_model}")
                 try:
                     logger.info("Loading tokenizer...")
-                    self.tokenizer = AutoTokenizer.from_pretrained(fallback_model)
+                    self.tokenizer = AutoTokenizer.from_pretrained(fallback_model, use_fast=True)
                     logger.info("Tokenizer loaded successfully")
                     
                     logger.info("Loading model...")
                     self.model = AutoModelForCausalLM.from_pretrained(
                         fallback_model,
-                        torch_dtype=torch.float32,
+                        torch_dtype=dtype,
                         low_cpu_mem_usage=True
                     )
                     self.model = self.model.to(device)
@@ -48,87 +95,354 @@ class ChatService:
                 logger.info(f"Loading model from: {model_path}")
                 try:
                     logger.info("Loading tokenizer...")
-                    self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+                    self.tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
                     logger.info("Tokenizer loaded successfully")
                     
                     logger.info("Loading model...")
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        model_path,
-                        torch_dtype=torch.float32,
-                        low_cpu_mem_usage=True
-                    )
+                    if is_adapter:
+                        # train.py saves only the LoRA adapter: load its base model
+                        # and fold the adapter weights in so inference runs a plain model
+                        from peft import AutoPeftModelForCausalLM
+                        
+                        self.model = AutoPeftModelForCausalLM.from_pretrained(
+                            model_path,
+                            torch_dtype=dtype,
+                            low_cpu_mem_usage=True
+                        ).merge_and_unload()
+                    else:
+                        self.model = AutoModelForCausalLM.from_pretrained(
+                            model_path,
+                            torch_dtype=dtype,
+                            low_cpu_mem_usage=True
+                        )
                     self.model = self.model.to(device)
                     logger.info("Model loaded successfully")
                 except Exception as e:
                     logger.error(f"Error loading local model: {str(e)}")
                     raise
+            
+            # Decoder-only generation needs left padding for the length buckets
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.eos_id = self.tokenizer.eos_token_id
+            
+            # Compile the forward pass with symbolic shapes: the legacy tuple KV
+            # cache grows by one token per decode step, so static shapes would
+            # recompile every step until torch falls back to eager
+            if device == "cuda":
+                logger.info("Compiling model forward pass...")
+                self.model.forward = torch.compile(self.model.forward, dynamic=True)
+                self._executor.submit(self._warmup).result()
+                logger.info("Model compiled successfully")
                 
-            # Initialize conversation history
-            self.conversation_history = {}
+                logger.info("Reserving CUDA memory for a full batch...")
+                self._executor.submit(self._reserve_memory).result()
+                logger.info(f"CUDA memory reserved: {torch.cuda.memory_reserved() / 2**20:.0f} MiB")
+            else:
+                cpu_runtime = os.environ.get("CPU_RUNTIME", "torch").lower()
+                # Optional weight-only quantization for CPU inference
+                quantize_cpu = os.environ.get("QUANTIZE_CPU", "").lower()
+                if cpu_runtime == "onnxruntime":
+                    # Export to ONNX and run generate() on ONNX Runtime's fused CPU kernels
+                    from optimum.onnxruntime import ORTModelForCausalLM
+                    
+                    logger.info("Exporting model to ONNX Runtime...")
+                    with tempfile.TemporaryDirectory() as merged_path:
+                        source = fallback_model if use_fallback else model_path
+                        if is_adapter:
+                            # The exporter needs a full checkpoint, so write out the merged weights
+                            self.model.save_pretrained(merged_path)
+                            self.tokenizer.save_pretrained(merged_path)
+                            source = merged_path
+                        self.model = ORTModelForCausalLM.from_pretrained(
+                            source,
+                            export=True,
+                            provider="CPUExecutionProvider",
+                            use_cache=True
+                        )
+                    logger.info("Model exported successfully")
+                elif quantize_cpu == "int8":
+                    logger.info("Quantizing linear layers to int8...")
+                    self.model = torch.quantization.quantize_dynamic(
+                        self.model,
+                        {torch.nn.Linear},
+                        dtype=torch.qint8
+                    )
+                    logger.info("Model quantized successfully")
+                elif quantize_cpu:
+                    logger.warning(f"Unsupported QUANTIZE_CPU value: {quantize_cpu}")
+                
+            # Initialize conversation history, least recently active user first
+            self.conversation_history: OrderedDict = OrderedDict()
             self.max_history = 5
+            self.max_users = int(os.environ.get("MAX_CONVERSATION_USERS", "10000"))
+            
+            # Per-user (token ids, past_key_values) left by the previous turn's prefill,
+            # least recently used first; each entry holds device memory for up to
+            # max_length tokens, so only the most recent users keep theirs
+            self.kv_cache: OrderedDict = OrderedDict()
+            self.max_cached_users = int(os.environ.get("KV_CACHE_USERS", "16"))
+            
+            # Pending (prompt ids, cache entry, future) items for the generation batcher, started on first use
+            self._generate_queue: asyncio.Queue = None
+            self._generate_task: asyncio.Task = None
             logger.info("Chat service initialized successfully")
             
         except Exception as e:
             logger.error(f"Error initializing chat service: {str(e)}")
             raise
 
+    def _warmup(self):
+        """Run one short generate so the first request doesn't pay for compilation."""
+        inputs = self.tokenizer(
+            "User: Hello\nAssistant:",
+            return_tensors="pt",
+            padding=True,
+            pad_to_multiple_of=PROMPT_BUCKET
+        ).to(self.model.device)
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                max_new_tokens=8,
+                pad_token_id=self.eos_id
+            )
+
+    def _reserve_memory(self):
+        """Run a full-size batch once so the CUDA allocator claims its peak pool up front."""
+        torch.cuda.empty_cache()
+        prompt_length = GENERATION_KWARGS["max_length"] - 1
+        input_ids = torch.full(
+            (GENERATION_MAX_BATCH, prompt_length),
+            self.eos_id,
+            dtype=torch.long,
+            device=self.model.device
+        )
+        with torch.no_grad():
+            self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=1,
+                pad_token_id=self.eos_id
+            )
+
+    def _get_history(self, user_id: str) -> deque:
+        """Get a user's history deque, marking them most recently active."""
+        history = self.conversation_history.get(user_id)
+        if history is None:
+            history = self.conversation_history[user_id] = deque(maxlen=self.max_history)
+            # Forget the least recently active user once over the limit
+            if len(self.conversation_history) > self.max_users:
+                evicted, _ = self.conversation_history.popitem(last=False)
+                self.kv_cache.pop(evicted, None)
+        else:
+            self.conversation_history.move_to_end(user_id)
+        return history
+
+    def _store_kv_cache(self, user_id: str, cache_entry: Tuple[List[int], Any]):
+        """Keep a user's KV cache, dropping the least recently used one once over the limit."""
+        self.kv_cache[user_id] = cache_entry
+        self.kv_cache.move_to_end(user_id)
+        while len(self.kv_cache) > self.max_cached_users:
+            self.kv_cache.popitem(last=False)
+
     def _get_conversation_context(self, user_id: str) -> str:
         """Get the conversation history for a user."""
-        if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = deque(maxlen=self.max_history)
-        
-        history = self.conversation_history[user_id]
+        history = self._get_history(user_id)
         if not history:
             return ""
         
         context = "Previous conversation:\n"
-        for q, a in history:
+        for q, a, _ in history:
             context += f"User: {q}\nAssistant: {a}\n"
         return context
 
     def _update_conversation_history(self, user_id: str, question: str, answer: str):
         """Update the conversation history for a user."""
-        if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = deque(maxlen=self.max_history)
-        self.conversation_history[user_id].append((question, answer))
+        # Keep the turn's token ids so later prompts don't re-tokenize it
+        turn_ids = self.tokenizer(
+            f"User: {question}\nAssistant: {answer}\n",
+            add_special_tokens=False
+        )["input_ids"]
+        self._get_history(user_id).append((question, answer, turn_ids))
+
+    def _blocking_generate(self, prompts: List[List[int]]) -> List[Tuple[str, None]]:
+        """Pad a batch of prompt token ids, run the model once and decode each reply."""
+        # Left-pad to the longest prompt in the batch
+        inputs = self.tokenizer.pad(
+            {"input_ids": prompts},
+            return_tensors="pt",
+            padding=True,
+            pad_to_multiple_of=PROMPT_BUCKET
+        ).to(self.model.device)
+        
+        # Generate responses
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                **GENERATION_KWARGS,
+                pad_token_id=self.eos_id
+            )
+        
+        # Decode only the generated tokens of each row
+        prompt_length = inputs["input_ids"].shape[1]
+        responses = self.tokenizer.batch_decode(
+            outputs[:, prompt_length:],
+            skip_special_tokens=True
+        )
+        return [(response.strip(), None) for response in responses]
+
+    def _blocking_generate_cached(
+        self,
+        prompt: List[int],
+        cache_entry: Optional[Tuple[List[int], Any]]
+    ) -> List[Tuple[str, Tuple[List[int], Any]]]:
+        """Run a single prompt, reusing the KV cache left by the user's previous turn."""
+        device = self.model.device
+        
+        # Keep the cached keys/values for the longest prefix shared with this prompt
+        past_key_values, cached = None, 0
+        if cache_entry is not None:
+            cached_ids, past_key_values = cache_entry
+            limit = min(len(cached_ids), len(prompt) - 1)
+            while cached < limit and cached_ids[cached] == prompt[cached]:
+                cached += 1
+            past_key_values = tuple(
+                (key[:, :, :cached], value[:, :, :cached])
+                for key, value in past_key_values
+            ) if cached else None
+        
+        with torch.no_grad():
+            # Prefill the uncached tokens except the last, which generate() feeds itself
+            if cached < len(prompt) - 1:
+                # The mask spans the cached and new tokens; ONNX Runtime's
+                # exported decoder requires it
+                outputs = self.model(
+                    input_ids=torch.tensor([prompt[cached:-1]], device=device),
+                    attention_mask=torch.ones(1, len(prompt) - 1, dtype=torch.long, device=device),
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
+                past_key_values = outputs.past_key_values
+            
+            input_ids = torch.tensor([prompt], device=device)
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                **GENERATION_KWARGS,
+                pad_token_id=self.eos_id
+            )
+        
+        response = self.tokenizer.decode(outputs[0, len(prompt):], skip_special_tokens=True)
+        
+        # Without a prefill the stored entry is still the prefix slices above,
+        # views that would keep the previous turn's full-length tensors alive;
+        # copy just those. A prefill's outputs are already new, compact tensors
+        if past_key_values is not None and cached == len(prompt) - 1:
+            past_key_values = tuple(
+                (key.clone(), value.clone())
+                for key, value in past_key_values
+            )
+        return [(response.strip(), (prompt[:-1], past_key_values))]
 
-    async def get_response(self, message: str, user_id: str) -> str:
+    async def _submit(
+        self,
+        prompt: List[int],
+        cache_entry: Optional[Tuple[List[int], Any]] = None
+    ) -> Tuple[str, Optional[Tuple[List[int], Any]]]:
+        """Queue a prompt for the shared generation batcher and wait for its reply."""
+        loop = asyncio.get_running_loop()
+        if self._generate_task is None or self._generate_task.done():
+            self._generate_queue = asyncio.Queue()
+            self._generate_task = loop.create_task(self._generate_batcher())
+        
+        future = loop.create_future()
+        self._generate_queue.put_nowait((prompt, cache_entry, future))
+        return await future
+
+    async def _run_generation(self, items: List[tuple], func, *args):
+        """Run a blocking generate function on the generation thread and resolve the items' futures."""
         try:
-            # Get conversation history
-            if user_id not in self.conversation_history:
-                self.conversation_history[user_id] = deque(maxlen=self.max_history)
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(self._executor, func, *args)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, _, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _generate_batcher(self):
+        """Coalesce queued prompts from concurrent chats into single generate() calls."""
+        while True:
+            items = await collect_batch(self._generate_queue, GENERATION_MAX_BATCH, GENERATION_BATCH_WAIT)
             
-            # Prepare input
-            conversation = list(self.conversation_history[user_id])
-            context = ""
-            for prev_msg, prev_resp in conversation:
-                context += f"User: {prev_msg}\nAssistant: {prev_resp}\n"
-            context += f"User: {message}\nAssistant:"
+            # Prompts without a cached prefix share one padded generate() call;
+            # the rest continue their own KV cache one at a time
+            fresh = [item for item in items if item[1] is None]
+            if len(fresh) > 1:
+                await self._run_generation(
+                    fresh,
+                    self._blocking_generate,
+                    [prompt for prompt, _, _ in fresh]
+                )
+                items = [item for item in items if item[1] is not None]
             
-            logger.info(f"Generating response for input: {message[:50]}...")
+            for item in items:
+                await self._run_generation([item], self._blocking_generate_cached, item[0], item[1])
+
+    async def close(self):
+        """Cancel the generation batcher and shut down the generation thread."""
+        if self._generate_task is not None:
+            self._generate_task.cancel()
+            try:
+                await self._generate_task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self._executor.shutdown, wait=True, cancel_futures=True)
+
+    def _context_ids(self, context: List[Dict]) -> List[int]:
+        """Tokenize retrieved documents into a bounded context block for the prompt."""
+        block = "Context:\n" + "".join(f"- {doc['content']}\n" for doc in context)
+        return self.tokenizer(
+            block,
+            add_special_tokens=False,
+            truncation=True,
+            max_length=CONTEXT_MAX_TOKENS
+        )["input_ids"]
+
+    async def get_response(
+        self,
+        message: str,
+        user_id: str,
+        context: Optional[List[Dict]] = None
+    ) -> str:
+        try:
+            # Prepare input from the cached history token ids plus the new turn.
+            # Retrieved context goes after the history so the cached prefix still matches
+            prompt = []
+            for _, _, turn_ids in self._get_history(user_id):
+                prompt.extend(turn_ids)
+            if context:
+                prompt.extend(self._context_ids(context))
+            prompt.extend(self.tokenizer(
+                f"User: {message}\nAssistant:",
+                add_special_tokens=False
+            )["input_ids"])
             
-            # Tokenize input
-            inputs = self.tokenizer(context, return_tensors="pt").to(self.model.device)
-            
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_length=512,
-                    num_return_sequences=1,
-                    temperature=0.7,
-                    top_p=0.9,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    repetition_penalty=1.2
-                )
+            logger.info(f"Generating response for input: {message[:50]}...")
             
-            # Decode response
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            response = response.replace(context, "").strip()
+            # Batch with any concurrent requests, reusing this user's KV cache
+            response, cache_entry = await self._submit(prompt, self.kv_cache.pop(user_id, None))
             
             # Update conversation history
-            self.conversation_history[user_id].append((message, response))
+            self._update_conversation_history(user_id, message, response)
+            if cache_entry is not None:
+                self._store_kv_cache(user_id, cache_entry)
             
             logger.info(f"Generated response: {response[:50]}...")
             return response
@@ -146,7 +460,7 @@ class ChatService:
         """Process a message and return a response."""
         try:
             # Generate response using the model
-            response = await self.get_response(message, user_id)
+            response = await self.get_response(message, user_id, context)
             
             return {
                 "message": response,
@@ -1,71 +1,208 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Dict, Any
+from datetime import datetime
+from itertools import count
 import faiss
 import numpy as np
+import torch
+from sortedcontainers import SortedDict
 from sentence_transformers import SentenceTransformer
 import json
 import os
 from app.core.config import settings
+from app.services.batching import collect_batch
+
+# Texts per batched encode call and how long the first queued text waits for company
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT = 0.010
+
+# Number of recent queries whose retrieved context is kept in memory
+CONTEXT_CACHE_SIZE = 1024
 
 class VectorStore:
     def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Embed on the GPU in half precision when one is available
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+        if device == 'cuda':
+            self.model.half()
         self.index_path = os.path.join(settings.VECTOR_DB_PATH, "faiss.index")
         self.metadata_path = os.path.join(settings.VECTOR_DB_PATH, "metadata.json")
         
         # Create vector store directory if it doesn't exist
         os.makedirs(settings.VECTOR_DB_PATH, exist_ok=True)
         
+        # Load metadata, keyed by document id in insertion order
+        self.metadata = self._load_metadata()
+        self._ids = count(self.metadata.peekitem(-1)[0] + 1 if self.metadata else 0)
+        
         # Initialize or load the FAISS index
         self._initialize_index()
+
+        # Pending (text, future) pairs for the embedding batcher, started on first use
+        self._embed_queue: asyncio.Queue = None
+        self._embed_task: asyncio.Task = None
         
-        # Load metadata
-        self.metadata = self._load_metadata()
+        # LRU of retrieved context keyed by (generation, query hash, k); the
+        # generation is bumped on every add/delete so stale entries never match
+        self._context_cache: OrderedDict = OrderedDict()
+        self._generation = 0
 
     def _initialize_index(self):
         """Initialize or load the FAISS index"""
         if os.path.exists(self.index_path):
             self.index = faiss.read_index(self.index_path)
+            if not isinstance(self.index, faiss.IndexIDMap):
+                # Older stores kept metadata as a list aligned with the index rows,
+                # and their ids (the list length at insert) repeat after a delete;
+                # re-key both by row position
+                vectors = self.index.reconstruct_n(0, self.index.ntotal)
+                self.metadata = self._load_metadata(by_position=True)
+                self._ids = count(len(self.metadata))
+                self._rebuild_index(vectors, np.arange(len(vectors), dtype=np.int64))
+                self._save_metadata()
+            elif self.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                # L2 index over unnormalized vectors; normalize them for cosine search
+                flat = faiss.downcast_index(self.index.index)
+                vectors = flat.reconstruct_n(0, flat.ntotal)
+                self._rebuild_index(vectors, faiss.vector_to_array(self.index.id_map))
         else:
-            # Create a new index with the correct dimension
+            # Create a new index with the correct dimension, keyed by document id
             dimension = self.model.get_sentence_embedding_dimension()
-            self.index = faiss.IndexFlatL2(dimension)
+            self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
             faiss.write_index(self.index, self.index_path)
 
-    def _load_metadata(self) -> List[Dict[str, Any]]:
-        """Load metadata from file"""
+    def _rebuild_index(self, vectors: np.ndarray, ids: np.ndarray):
+        """Replace the index with a cosine index over the given vectors"""
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        faiss.normalize_L2(vectors)
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(vectors.shape[1]))
+        self.index.add_with_ids(vectors, ids)
+        faiss.write_index(self.index, self.index_path)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts as unit vectors so inner product is cosine similarity"""
+        return self.model.encode(
+            texts,
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+
+    def _load_metadata(self, by_position: bool = False) -> "SortedDict[int, Dict[str, Any]]":
+        """Load metadata from file, parsing timestamps once up front
+
+        With by_position, each document is re-keyed by its position in the
+        file instead of its stored id.
+        """
+        metadata = SortedDict()
         if os.path.exists(self.metadata_path):
             with open(self.metadata_path, 'r') as f:
-                return json.load(f)
-        return []
+                for position, doc in enumerate(json.load(f)):
+                    doc["timestamp"] = datetime.fromisoformat(doc["timestamp"])
+                    if by_position:
+                        doc["id"] = position
+                    metadata[doc["id"]] = doc
+        return metadata
 
     def _save_metadata(self):
         """Save metadata to file"""
         with open(self.metadata_path, 'w') as f:
-            json.dump(self.metadata, f)
+            json.dump(list(self.metadata.values()), f, default=datetime.isoformat)
+
+    async def add_document(self, content: str, source: str) -> int:
+        """
+        Add a document to the vector store and return its id
+        """
+        return (await self.add_documents([content], [source]))[0]
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Queue texts for the shared embedding batcher and wait for their vectors
+        """
+        loop = asyncio.get_running_loop()
+        if self._embed_task is None or self._embed_task.done():
+            self._embed_queue = asyncio.Queue()
+            self._embed_task = loop.create_task(self._embed_batcher())
+        
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self._embed_queue.put_nowait((text, future))
+            futures.append(future)
+        return np.stack(await asyncio.gather(*futures))
+
+    async def _embed_batcher(self):
+        """
+        Coalesce queued texts from concurrent callers into single encode calls
+        """
+        while True:
+            items = await collect_batch(self._embed_queue, EMBED_BATCH_SIZE, EMBED_BATCH_WAIT)
+            
+            try:
+                embeddings = await asyncio.to_thread(self._encode, [text for text, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(items, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    async def aclose(self):
+        """
+        Cancel the embedding batcher if it was started
+        """
+        if self._embed_task is not None:
+            self._embed_task.cancel()
+            try:
+                await self._embed_task
+            except asyncio.CancelledError:
+                pass
+            self._embed_task = None
 
-    async def add_document(self, content: str, source: str):
+    async def add_documents(self, contents: List[str], sources: List[str]) -> List[int]:
         """
-        Add a document to the vector store
+        Add a batch of documents to the vector store with a single encode pass
+        and return their ids
         """
         try:
-            # Generate embedding
-            embedding = self.model.encode([content])[0]
+            if not contents:
+                return []
             
-            # Add to FAISS index
-            self.index.add(np.array([embedding]).astype('float32'))
+            # Generate embeddings, batched with any concurrent uploads
+            embeddings = await self._embed(contents)
+            
+            # Add to FAISS index under the new document ids
+            doc_ids = [next(self._ids) for _ in contents]
+            self.index.add_with_ids(
+                np.asarray(embeddings).astype('float32'),
+                np.array(doc_ids, dtype=np.int64)
+            )
             
             # Add metadata
-            self.metadata.append({
-                "id": len(self.metadata),
-                "content": content,
-                "source": source,
-                "timestamp": datetime.utcnow().isoformat()
-            })
+            timestamp = datetime.utcnow()
+            for doc_id, content, source in zip(doc_ids, contents, sources):
+                self.metadata[doc_id] = {
+                    "id": doc_id,
+                    "content": content,
+                    "source": source,
+                    "timestamp": timestamp
+                }
+            self._generation += 1
             
             # Save changes
             faiss.write_index(self.index, self.index_path)
             self._save_metadata()
             
+            return doc_ids
+            
         except Exception as e:
             raise Exception(f"Error adding document to vector store: {str(e)}")
 
@@ -77,9 +214,20 @@ class VectorStore:
         """
         Retrieve relevant context for a query
         """
+        key = (
+            self._generation,
+            hashlib.blake2b(query.encode(), digest_size=16).digest(),
+            k
+        )
+        cached = self._context_cache.get(key)
+        if cached is not None:
+            self._context_cache.move_to_end(key)
+            # Hand out a copy so callers can't alter the cached list
+            return list(cached)
+        
         try:
-            # Generate query embedding
-            query_embedding = self.model.encode([query])[0]
+            # Generate query embedding, batched with any concurrent lookups
+            query_embedding = (await self._embed([query]))[0]
             
             # Search in FAISS index
             distances, indices = self.index.search(
@@ -87,13 +235,18 @@ class VectorStore:
                 k
             )
             
-            # Get relevant documents from metadata
+            # Get relevant documents from metadata; the index returns document ids
             relevant_docs = []
-            for idx in indices[0]:
-                if idx < len(self.metadata):
-                    relevant_docs.append(self.metadata[idx])
+            for doc_id in indices[0]:
+                doc = self.metadata.get(int(doc_id))
+                if doc is not None:
+                    relevant_docs.append(doc)
+            
+            self._context_cache[key] = relevant_docs
+            if len(self._context_cache) > CONTEXT_CACHE_SIZE:
+                self._context_cache.popitem(last=False)
             
-            return relevant_docs
+            return list(relevant_docs)
             
         except Exception as e:
             raise Exception(f"Error retrieving context: {str(e)}")
@@ -104,22 +257,31 @@ class VectorStore:
         """
         try:
             # Remove from metadata
-            if 0 <= doc_id < len(self.metadata):
-                self.metadata.pop(doc_id)
-                
-                # Rebuild index without the deleted document
-                dimension = self.model.get_sentence_embedding_dimension()
-                new_index = faiss.IndexFlatL2(dimension)
+            if self.metadata.pop(doc_id, None) is not None:
+                self._generation += 1
                 
-                # Re-add all documents except the deleted one
-                for i, doc in enumerate(self.metadata):
-                    embedding = self.model.encode([doc["content"]])[0]
-                    new_index.add(np.array([embedding]).astype('float32'))
-                
-                # Replace old index with new one
-                self.index = new_index
+                # Drop its vector from the index without touching the rest
+                self.index.remove_ids(np.array([doc_id], dtype=np.int64))
                 faiss.write_index(self.index, self.index_path)
                 self._save_metadata()
                 
         except Exception as e:
-            raise Exception(f"Error deleting document: {str(e)}") 
\ No newline at end of file
+            raise Exception(f"Error deleting document: {str(e)}") 
+
+    def clear(self):
+        """
+        Remove every document and reset ids, keeping the loaded embedding model
+        """
+        self.metadata.clear()
+        self._ids = count(0)
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(self.index.d))
+        self._context_cache.clear()
+        self._generation += 1
+        
+        faiss.write_index(self.index, self.index_path)
+        self._save_metadata()
+
+@lru_cache(maxsize=1)
+def get_vector_store() -> VectorStore:
+    """Return the process-wide vector store"""
+    return VectorStore()
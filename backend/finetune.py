@@ -5,29 +5,26 @@ from transformers import (
     AutoTokenizer,
     TrainingArguments,
     Trainer,
-    DataCollatorForLanguageModeling
+    DataCollatorForLanguageModeling,
+    BitsAndBytesConfig
 )
 from datasets import Dataset
+from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import os
 from typing import Dict, List
+from training_utils import ensure_pad_token, tokenize_texts
 
 def load_dataset(file_path: str) -> pd.DataFrame:
     """Load and preprocess the dataset."""
     df = pd.read_csv(file_path)
     # Combine query and response into a single text
-    df['text'] = df.apply(lambda row: f"Question: {row['Query']}\nAnswer: {row['Response']}", axis=1)
+    df['text'] = "Question: " + df['Query'].astype(str) + "\nAnswer: " + df['Response'].astype(str)
     return df
 
 def prepare_dataset(df: pd.DataFrame, tokenizer: AutoTokenizer) -> Dataset:
     """Prepare the dataset for training."""
     def tokenize_function(examples):
-        return tokenizer(
-            examples["text"],
-            padding="max_length",
-            truncation=True,
-            max_length=512,
-            return_tensors="pt"
-        )
+        return tokenize_texts(tokenizer, examples["text"], max_length=512)
     
     # Convert DataFrame to HuggingFace Dataset
     dataset = Dataset.from_pandas(df)
@@ -35,6 +32,8 @@ def prepare_dataset(df: pd.DataFrame, tokenizer: AutoTokenizer) -> Dataset:
     tokenized_dataset = dataset.map(
         tokenize_function,
         batched=True,
+        batch_size=1000,
+        num_proc=max(1, (os.cpu_count() or 1) // 2),
         remove_columns=dataset.column_names
     )
     return tokenized_dataset
@@ -45,12 +44,45 @@ def train_model(
     output_dir: str = "finetuned_model",
     num_train_epochs: int = 3,
     batch_size: int = 4,
-    learning_rate: float = 2e-5
+    learning_rate: float = 2e-5,
+    gradient_accumulation_steps: int = 8
 ):
     """Train the model on the banking chatbot dataset."""
     # Load tokenizer and model
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
+    tokenizer = ensure_pad_token(AutoTokenizer.from_pretrained(model_name, use_fast=True))
+    
+    # Mixed precision: bf16 where supported, fp16 on older GPUs
+    use_cuda = torch.cuda.is_available()
+    use_bf16 = use_cuda and torch.cuda.is_bf16_supported()
+    
+    # QLoRA on GPU: load the frozen base model in 4-bit NF4. Gradient
+    # checkpointing recomputes activations in the backward pass either way
+    if use_cuda:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16 if use_bf16 else torch.float16,
+                bnb_4bit_quant_type="nf4"
+            ),
+            device_map={"": 0}
+        )
+        model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=True)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+    model.config.use_cache = False
+    
+    # Train low-rank adapters on the attention projections only
+    model = get_peft_model(model, LoraConfig(
+        r=16,
+        lora_alpha=32,
+        lora_dropout=0.05,
+        target_modules=["q_proj", "k_proj", "v_proj", "dense"],
+        task_type="CAUSAL_LM"
+    ))
+    model.print_trainable_parameters()
     
     # Load and prepare dataset
     df = load_dataset(dataset_path)
@@ -65,6 +97,15 @@ def train_model(
         num_train_epochs=num_train_epochs,
         per_device_train_batch_size=batch_size,
         per_device_eval_batch_size=batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        gradient_checkpointing=True,
+        bf16=use_bf16,
+        fp16=use_cuda and not use_bf16,
+        optim="adamw_torch_fused" if use_cuda else "adamw_torch",
+        dataloader_num_workers=max(1, (os.cpu_count() or 1) // 2),
+        dataloader_pin_memory=use_cuda,
+        group_by_length=True,
+        length_column_name="length",
         learning_rate=learning_rate,
         weight_decay=0.01,
         logging_dir="./logs",
@@ -81,13 +122,17 @@ def train_model(
         args=training_args,
         train_dataset=split_dataset["train"],
         eval_dataset=split_dataset["test"],
-        data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+        data_collator=DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,
+            pad_to_multiple_of=8
+        ),
     )
     
     # Train the model
     trainer.train()
     
-    # Save the model and tokenizer
+    # Save the LoRA adapter and tokenizer
     trainer.save_model()
     tokenizer.save_pretrained(output_dir)
     
@@ -0,0 +1,108 @@
+import os
+import pytest
+from pytest_asyncio import is_async_test
+from datetime import timedelta
+from unittest.mock import MagicMock
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+
+# Cheapest bcrypt cost for the whole run; set before the app is imported so
+# anything building a CryptContext at import time sees it too
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+def pytest_collection_modifyitems(items):
+    # Run every async test on the session loop so session fixtures can hold
+    # loop-bound state (the chat and embedding batchers' queues)
+    session_loop = pytest.mark.asyncio(loop_scope="session")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_loop, append=False)
+
+class FakeSession:
+    """Stand-in for a SQLAlchemy Session exposing only what the services call."""
+
+    ATTRIBUTES = ("query", "add", "commit", "refresh", "delete")
+
+    def __init__(self):
+        for name in self.ATTRIBUTES:
+            setattr(self, name, MagicMock())
+
+    def reset_mock(self, **kwargs):
+        for name in self.ATTRIBUTES:
+            getattr(self, name).reset_mock(**kwargs)
+
+@pytest.fixture(scope="session")
+def mock_db():
+    return FakeSession()
+
+# Session- and module-scoped mocks shared between tests: the db session here
+# and the OpenAI patches defined in test_chat.py / test_document.py
+SHARED_MOCKS = ("mock_db", "mock_openai_chat", "mock_openai_embedding")
+
+@pytest.fixture(autouse=True)
+def reset_shared_mocks(request):
+    # Drop calls and configured return values from every shared mock this test used
+    mocks = [request.getfixturevalue(name) for name in SHARED_MOCKS if name in request.fixturenames]
+    yield
+    for mock in mocks:
+        mock.reset_mock(return_value=True, side_effect=True)
+
+@pytest.fixture(scope="session")
+def fast_bcrypt():
+    # Minimum bcrypt cost; the tests only need hashes that verify, not strong ones
+    pytest.importorskip("app.services.auth")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(
+            "app.services.auth.pwd_context",
+            CryptContext(schemes=["bcrypt"], bcrypt__rounds=int(os.environ["BCRYPT_ROUNDS"]))
+        )
+        yield
+
+@pytest.fixture(scope="session")
+def hashed_testpass(fast_bcrypt, mock_db):
+    from app.services.auth import AuthService
+    return AuthService(mock_db).get_password_hash("testpass123")
+
+@pytest.fixture(scope="session")
+def client():
+    from app.main import app
+    return TestClient(app)
+
+@pytest.fixture(scope="session")
+def mock_user():
+    User = pytest.importorskip("app.models.user").User
+    return User(
+        id=1,
+        username="testuser",
+        email="test@example.com",
+        hashed_password="hashed_password",
+        full_name="Test User"
+    )
+
+@pytest.fixture(scope="session")
+def mock_document():
+    Document = pytest.importorskip("app.models.document").Document
+    return Document(
+        id=1,
+        user_id=1,
+        filename="test.pdf",
+        content="Test document content",
+        embedding=(0.1, 0.2, 0.3)
+    )
+
+@pytest.fixture(scope="session")
+def mock_chat_message():
+    from app.models.chat import ChatMessage
+    return ChatMessage(
+        id=1,
+        user_id=1,
+        content="Test message",
+        is_user=True
+    )
+
+@pytest.fixture(scope="session")
+def auth_headers():
+    # One token for the whole run, valid well past any test session
+    create_access_token = pytest.importorskip("app.core.security").create_access_token
+    token = create_access_token({"sub": "testuser"}, expires_delta=timedelta(hours=24))
+    return {"Authorization": f"Bearer {token}"}
@@ -1,49 +1,4 @@
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
-from app.main import app
-from app.models.user import User
-from app.models.document import Document
-from app.models.chat import ChatMessage
-from app.core.security import create_access_token
-
-@pytest.fixture
-def client():
-    return TestClient(app)
-
-@pytest.fixture
-def mock_user():
-    return User(
-        id=1,
-        username="testuser",
-        email="test@example.com",
-        hashed_password="hashed_password",
-        full_name="Test User"
-    )
-
-@pytest.fixture
-def mock_document():
-    return Document(
-        id=1,
-        user_id=1,
-        filename="test.pdf",
-        content="Test document content",
-        embedding=[0.1, 0.2, 0.3]
-    )
-
-@pytest.fixture
-def mock_chat_message():
-    return ChatMessage(
-        id=1,
-        user_id=1,
-        content="Test message",
-        is_user=True
-    )
-
-@pytest.fixture
-def auth_headers(mock_user):
-    token = create_access_token({"sub": mock_user.username})
-    return {"Authorization": f"Bearer {token}"}
 
 def test_register_user(client):
     # Arrange
@@ -1,38 +1,22 @@
 import pytest
-from unittest.mock import Mock, patch
-from datetime import datetime, timedelta
+from unittest.mock import Mock
+from datetime import timedelta
 from jose import JWTError
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
 from app.services.auth import AuthService
 from app.models.user import User
-from app.core.config import settings
 from app.core.security import create_access_token
 
 @pytest.fixture
-def mock_db():
-    return Mock(spec=Session)
-
-@pytest.fixture
-def mock_user():
-    return User(
-        id=1,
-        username="testuser",
-        email="test@example.com",
-        hashed_password="hashed_password",
-        full_name="Test User"
-    )
-
-@pytest.fixture
-def auth_service(mock_db):
+def auth_service(mock_db, fast_bcrypt):
     return AuthService(mock_db)
 
-def test_create_user(auth_service):
+def test_create_user(auth_service, monkeypatch):
     # Arrange
     username = "newuser"
     email = "new@example.com"
     password = "testpass123"
     full_name = "New User"
+    monkeypatch.setattr(auth_service, "get_password_hash", lambda p: "hashed_" + p)
     auth_service.db.add = Mock()
     auth_service.db.commit = Mock()
     auth_service.db.refresh = Mock()
@@ -112,38 +96,24 @@ def test_authenticate_user_not_found(auth_service):
     # Assert
     assert user is None
 
-def test_verify_password(auth_service):
-    # Arrange
-    password = "testpass123"
-    hashed_password = auth_service.get_password_hash(password)
-
+def test_verify_password(auth_service, hashed_testpass):
     # Act
-    is_valid = auth_service.verify_password(password, hashed_password)
+    is_valid = auth_service.verify_password("testpass123", hashed_testpass)
 
     # Assert
     assert is_valid is True
 
-def test_verify_password_invalid(auth_service):
-    # Arrange
-    password = "testpass123"
-    hashed_password = auth_service.get_password_hash(password)
-
+def test_verify_password_invalid(auth_service, hashed_testpass):
     # Act
-    is_valid = auth_service.verify_password("wrongpass", hashed_password)
+    is_valid = auth_service.verify_password("wrongpass", hashed_testpass)
 
     # Assert
     assert is_valid is False
 
-def test_get_password_hash(auth_service):
-    # Arrange
-    password = "testpass123"
-
-    # Act
-    hashed_password = auth_service.get_password_hash(password)
-
+def test_get_password_hash(hashed_testpass):
     # Assert
-    assert hashed_password != password
-    assert isinstance(hashed_password, str)
+    assert hashed_testpass != "testpass123"
+    assert isinstance(hashed_testpass, str)
 
 def test_create_access_token():
     # Arrange
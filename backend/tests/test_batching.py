@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+from app.services.batching import collect_batch
+
+@pytest.mark.asyncio
+async def test_collect_batch_stops_at_max_size():
+    """Test that a full batch returns without waiting out the deadline"""
+    queue = asyncio.Queue()
+    for i in range(5):
+        queue.put_nowait(i)
+
+    items = await collect_batch(queue, max_size=3, max_wait=60)
+
+    assert items == [0, 1, 2]
+    assert queue.qsize() == 2
+
+@pytest.mark.asyncio
+async def test_collect_batch_returns_partial_batch_after_wait():
+    """Test that a lone item is released once max_wait passes"""
+    queue = asyncio.Queue()
+    queue.put_nowait("only")
+
+    items = await collect_batch(queue, max_size=8, max_wait=0.01)
+
+    assert items == ["only"]
+
+@pytest.mark.asyncio
+async def test_collect_batch_picks_up_late_arrivals():
+    """Test that items queued during the wait join the batch"""
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.005, queue.put_nowait, "second")
+    queue.put_nowait("first")
+
+    items = await collect_batch(queue, max_size=8, max_wait=0.05)
+
+    assert items == ["first", "second"]
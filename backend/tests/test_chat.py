@@ -1,41 +1,21 @@
 import pytest
 from unittest.mock import Mock, patch
-from fastapi.testclient import TestClient
-from sqlalchemy.orm import Session
 from app.services.chat import ChatService
 from app.models.chat import ChatMessage
-from app.models.user import User
 from app.models.document import Document
-from app.core.config import settings
 
-@pytest.fixture
-def mock_db():
-    return Mock(spec=Session)
-
-@pytest.fixture
-def mock_user():
-    return User(
-        id=1,
-        username="testuser",
-        email="test@example.com",
-        hashed_password="hashed_password",
-        full_name="Test User"
-    )
-
-@pytest.fixture
-def mock_document():
-    return Document(
-        id=1,
-        user_id=1,
-        filename="test.pdf",
-        content="Test document content",
-        embedding=[0.1, 0.2, 0.3]
-    )
+# Payload returned by the patched ChatCompletion.create
+_OPENAI_CHAT_RESP = {"choices": [{"message": {"content": "Test response"}}]}
 
 @pytest.fixture
 def chat_service(mock_db):
     return ChatService(mock_db)
 
+@pytest.fixture(scope="module")
+def mock_openai_chat():
+    with patch('app.services.chat.openai.ChatCompletion.create') as mock:
+        yield mock
+
 def test_create_chat_message(chat_service, mock_user):
     # Arrange
     content = "Test message"
@@ -97,12 +77,9 @@ def test_get_relevant_context_no_documents(chat_service, mock_user):
     # Assert
     assert context == ""
 
-@patch('app.services.chat.openai.ChatCompletion.create')
-def test_get_chat_response(mock_openai, chat_service, mock_user):
+def test_get_chat_response(mock_openai_chat, chat_service, mock_user):
     # Arrange
-    mock_openai.return_value = {
-        "choices": [{"message": {"content": "Test response"}}]
-    }
+    mock_openai_chat.return_value = _OPENAI_CHAT_RESP
     chat_service.get_relevant_context = Mock(return_value="Test context")
     chat_service.create_chat_message = Mock()
 
@@ -111,14 +88,13 @@ def test_get_chat_response(mock_openai, chat_service, mock_user):
 
     # Assert
     assert response == "Test response"
-    mock_openai.assert_called_once()
+    mock_openai_chat.assert_called_once()
     chat_service.get_relevant_context.assert_called_once_with(mock_user.id, "test query")
     chat_service.create_chat_message.assert_called()
 
-@patch('app.services.chat.openai.ChatCompletion.create')
-def test_get_chat_response_error(mock_openai, chat_service, mock_user):
+def test_get_chat_response_error(mock_openai_chat, chat_service, mock_user):
     # Arrange
-    mock_openai.side_effect = Exception("API Error")
+    mock_openai_chat.side_effect = Exception("API Error")
     chat_service.get_relevant_context = Mock(return_value="Test context")
 
     # Act & Assert
@@ -1,15 +1,23 @@
 import pytest
 from app.services.chat_service import ChatService
 from app.services.vector_store import VectorStore
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def chat_service():
     return ChatService()
 
+@pytest.fixture(scope="session")
+async def shared_vector_store():
+    store = VectorStore()
+    yield store
+    await store.aclose()
+
 @pytest.fixture
-def vector_store():
-    return VectorStore()
+def vector_store(shared_vector_store):
+    # Reuse the loaded embedding model; only the stored documents are reset
+    yield shared_vector_store
+    shared_vector_store.clear()
 
 @pytest.mark.asyncio
 async def test_generate_response(chat_service):
@@ -1,40 +1,20 @@
 import pytest
 from unittest.mock import Mock, patch
-from fastapi import UploadFile
-from sqlalchemy.orm import Session
 from app.services.document import DocumentService
 from app.models.document import Document
-from app.models.user import User
-from app.core.config import settings
 
-@pytest.fixture
-def mock_db():
-    return Mock(spec=Session)
-
-@pytest.fixture
-def mock_user():
-    return User(
-        id=1,
-        username="testuser",
-        email="test@example.com",
-        hashed_password="hashed_password",
-        full_name="Test User"
-    )
-
-@pytest.fixture
-def mock_document():
-    return Document(
-        id=1,
-        user_id=1,
-        filename="test.pdf",
-        content="Test document content",
-        embedding=[0.1, 0.2, 0.3]
-    )
+# Payload returned by the patched Embedding.create
+_OPENAI_EMBEDDING_RESP = {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
 
 @pytest.fixture
 def document_service(mock_db):
     return DocumentService(mock_db)
 
+@pytest.fixture(scope="module")
+def mock_openai_embedding():
+    with patch('app.services.document.openai.Embedding.create') as mock:
+        yield mock
+
 def test_create_document(document_service, mock_user):
     # Arrange
     filename = "test.pdf"
@@ -119,24 +99,20 @@ def test_delete_document_not_found(document_service):
         document_service.delete_document(999)
     assert str(exc_info.value) == "Document not found"
 
-@patch('app.services.document.openai.Embedding.create')
-def test_generate_embedding(mock_openai, document_service):
+def test_generate_embedding(mock_openai_embedding, document_service):
     # Arrange
-    mock_openai.return_value = {
-        "data": [{"embedding": [0.1, 0.2, 0.3]}]
-    }
+    mock_openai_embedding.return_value = _OPENAI_EMBEDDING_RESP
 
     # Act
     embedding = document_service.generate_embedding("Test content")
 
     # Assert
     assert embedding == [0.1, 0.2, 0.3]
-    mock_openai.assert_called_once()
+    mock_openai_embedding.assert_called_once()
 
-@patch('app.services.document.openai.Embedding.create')
-def test_generate_embedding_error(mock_openai, document_service):
+def test_generate_embedding_error(mock_openai_embedding, document_service):
     # Arrange
-    mock_openai.side_effect = Exception("API Error")
+    mock_openai_embedding.side_effect = Exception("API Error")
 
     # Act & Assert
     with pytest.raises(Exception) as exc_info:
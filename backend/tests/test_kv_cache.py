@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+import pytest
+import torch
+from app.services.chat_service import ChatService
+
+EOS = 0
+
+class FakeModel:
+    """Stand-in causal LM whose cached keys/values are the token ids themselves."""
+
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.prefilled = []
+        self.prefill_masks = []
+        self.generate_past = []
+
+    def __call__(self, input_ids, attention_mask, past_key_values=None, use_cache=True):
+        self.prefilled.append(input_ids[0].tolist())
+        self.prefill_masks.append(attention_mask)
+        new = input_ids.to(torch.float32).view(1, 1, -1, 1)
+        if past_key_values is not None:
+            new = torch.cat([past_key_values[0][0], new], dim=2)
+        return SimpleNamespace(past_key_values=((new, new.clone()),))
+
+    def generate(self, input_ids, past_key_values=None, **kwargs):
+        self.generate_past.append(past_key_values)
+        return torch.cat([input_ids, torch.tensor([[EOS]])], dim=1)
+
+class FakeTokenizer:
+    """One token per character, so prompts decode back to their text."""
+
+    def __call__(self, text, add_special_tokens=False, truncation=False, max_length=None):
+        ids = [ord(char) for char in text]
+        return {"input_ids": ids[:max_length] if truncation else ids}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " reply "
+
+@pytest.fixture
+def chat_service():
+    # Skip __init__'s model loading; only the cache bookkeeping is exercised
+    service = ChatService.__new__(ChatService)
+    service.model = FakeModel()
+    service.tokenizer = FakeTokenizer()
+    service.eos_id = EOS
+    service.kv_cache = OrderedDict()
+    service.max_cached_users = 2
+    service.conversation_history = OrderedDict()
+    service.max_history = 5
+    service.max_users = 10
+    return service
+
+def cached_tokens(cache_entry):
+    _, past_key_values = cache_entry
+    return past_key_values[0][0].flatten().int().tolist()
+
+def test_first_turn_prefills_all_but_last_token(chat_service):
+    """Test that a prompt without a cache is prefilled up to its last token"""
+    [(response, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 4], None)
+
+    assert response == "reply"
+    assert chat_service.model.prefilled == [[1, 2, 3]]
+    assert cache_entry[0] == [1, 2, 3]
+    assert cached_tokens(cache_entry) == [1, 2, 3]
+
+def test_next_turn_prefills_only_new_tokens(chat_service):
+    """Test that a prompt extending the cached ids reuses their keys/values"""
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 4], None)
+
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 4, 5, 6], cache_entry)
+
+    assert chat_service.model.prefilled[-1] == [4, 5]
+    # The mask covers the three cached tokens as well as the two prefilled ones
+    assert chat_service.model.prefill_masks[-1].tolist() == [[1, 1, 1, 1, 1]]
+    assert cached_tokens(cache_entry) == [1, 2, 3, 4, 5]
+
+def test_diverging_prompt_keeps_shared_prefix(chat_service):
+    """Test that only the prefix shared with the cached ids is reused"""
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 4], None)
+
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 9, 9], cache_entry)
+
+    assert chat_service.model.prefilled[-1] == [9]
+    assert cached_tokens(cache_entry) == [1, 2, 9]
+
+def test_stored_cache_does_not_share_memory_with_previous_turn(chat_service):
+    """Test that a trimmed prefix is copied rather than kept as a view"""
+    [(_, previous)] = chat_service._blocking_generate_cached([1, 2, 3, 4, 5], None)
+
+    # Nothing left to prefill, so the trimmed prefix goes straight to generate()
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 7], previous)
+
+    assert chat_service.model.prefilled == [[1, 2, 3, 4]]
+    assert cached_tokens(cache_entry) == [1, 2, 3]
+    stored, old = cache_entry[1][0][0], previous[1][0][0]
+    assert stored.untyped_storage().data_ptr() != old.untyped_storage().data_ptr()
+
+def test_kv_cache_evicts_least_recently_used_user(chat_service):
+    """Test that only the most recently stored users keep a KV cache"""
+    chat_service._store_kv_cache("alice", ([1], None))
+    chat_service._store_kv_cache("bob", ([2], None))
+    chat_service._store_kv_cache("alice", ([3], None))
+    chat_service._store_kv_cache("carol", ([4], None))
+
+    assert list(chat_service.kv_cache) == ["alice", "carol"]
+    assert chat_service.kv_cache["alice"] == ([3], None)
+
+@pytest.mark.asyncio
+async def test_context_goes_between_history_and_new_turn(chat_service, monkeypatch):
+    """Test that retrieved context reaches the prompt without breaking the cached prefix"""
+    prompts = []
+    async def submit(prompt, cache_entry=None):
+        prompts.append("".join(map(chr, prompt)))
+        return "reply", None
+    monkeypatch.setattr(chat_service, "_submit", submit)
+    chat_service._update_conversation_history("alice", "Hi", "Hello")
+
+    await chat_service.get_response("Rates?", "alice", context=[{"content": "Rates are 5%"}])
+
+    assert prompts == [
+        "User: Hi\nAssistant: Hello\n"
+        "Context:\n- Rates are 5%\n"
+        "User: Rates?\nAssistant:"
+    ]
+
+def test_prefilled_cache_is_stored_without_copying(chat_service):
+    """Test that a prefill's fresh keys/values are stored as they are"""
+    [(_, cache_entry)] = chat_service._blocking_generate_cached([1, 2, 3, 4], None)
+
+    assert cache_entry[1] is chat_service.model.generate_past[-1]
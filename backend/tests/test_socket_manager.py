@@ -0,0 +1,71 @@
+import pytest
+from unittest.mock import AsyncMock
+from app.core import socket_manager
+from app.core.socket_manager import CONNECTION_TIMEOUT, connect, chat_message, expire_connections
+
+@pytest.fixture(autouse=True)
+def clean_registry(monkeypatch):
+    """Give each test an empty connection registry and expiry heap"""
+    monkeypatch.setattr(socket_manager, "active_connections", {})
+    monkeypatch.setattr(socket_manager, "expiry_heap", [])
+
+def fake_websocket(close_error=None):
+    websocket = AsyncMock()
+    websocket.close.side_effect = close_error
+    return websocket
+
+@pytest.mark.asyncio
+async def test_idle_connection_expires():
+    """Test that a connection past its timeout is closed and forgotten"""
+    websocket = fake_websocket()
+    await connect("idle", websocket)
+    connected_at = socket_manager.active_connections["idle"]["last_activity"]
+
+    await expire_connections(connected_at + CONNECTION_TIMEOUT + 1)
+
+    assert "idle" not in socket_manager.active_connections
+    websocket.close.assert_awaited_once()
+    assert socket_manager.expiry_heap == []
+
+@pytest.mark.asyncio
+async def test_recent_activity_supersedes_old_expiry():
+    """Test that a stale heap entry does not drop a connection that was active since"""
+    websocket = fake_websocket()
+    await connect("busy", websocket)
+    connection = socket_manager.active_connections["busy"]
+    connected_at = connection["last_activity"]
+    # Activity just before the first expiry pushes a later one
+    connection["last_activity"] = connected_at + CONNECTION_TIMEOUT
+    socket_manager.expiry_heap.append((connected_at + 2 * CONNECTION_TIMEOUT, "busy"))
+
+    await expire_connections(connected_at + CONNECTION_TIMEOUT + 1)
+
+    assert "busy" in socket_manager.active_connections
+    websocket.close.assert_not_awaited()
+    assert len(socket_manager.expiry_heap) == 1
+
+@pytest.mark.asyncio
+async def test_failed_close_does_not_stop_expiry():
+    """Test that a close error on a dead socket still expires the remaining connections"""
+    dead = fake_websocket(close_error=RuntimeError("already closed"))
+    alive = fake_websocket()
+    await connect("dead", dead)
+    await connect("alive", alive)
+    latest = max(c["last_activity"] for c in socket_manager.active_connections.values())
+
+    await expire_connections(latest + CONNECTION_TIMEOUT + 1)
+
+    assert socket_manager.active_connections == {}
+    dead.close.assert_awaited_once()
+    alive.close.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_chat_message_refreshes_expiry():
+    """Test that a message pushes a later expiry for its connection"""
+    websocket = fake_websocket()
+    await connect("chatty", websocket)
+
+    await chat_message("chatty", {"message": "hi"})
+
+    assert [sid for _, sid in socket_manager.expiry_heap] == ["chatty", "chatty"]
+    websocket.send_json.assert_awaited_once()
@@ -0,0 +1,154 @@
+import json
+import zlib
+import faiss
+import numpy as np
+import pytest
+from app.services import vector_store
+
+class FakeEncoder:
+    """Deterministic stand-in for SentenceTransformer: one fixed vector per text."""
+
+    DIM = 8
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def half(self):
+        return self
+
+    def get_sentence_embedding_dimension(self):
+        return self.DIM
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        vectors = np.stack([
+            np.random.default_rng(zlib.crc32(text.encode())).standard_normal(self.DIM)
+            for text in texts
+        ]).astype('float32')
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+@pytest.fixture
+async def make_store(tmp_path, monkeypatch):
+    """Build VectorStores over a temporary directory with the fake encoder"""
+    monkeypatch.setattr(vector_store.settings, "VECTOR_DB_PATH", str(tmp_path))
+    monkeypatch.setattr(vector_store, "SentenceTransformer", FakeEncoder)
+    stores = []
+    def make():
+        stores.append(vector_store.VectorStore())
+        return stores[-1]
+    yield make
+    # Stop each store's embedding batcher before the session loop moves on
+    for store in stores:
+        await store.aclose()
+
+def test_legacy_store_is_rekeyed_by_row_position(tmp_path, make_store):
+    """Test migrating a positional store whose ids repeat after a delete"""
+    contents = ["alpha", "beta", "gamma"]
+    legacy_index = faiss.IndexFlatL2(FakeEncoder.DIM)
+    legacy_index.add(FakeEncoder().encode(contents))
+    faiss.write_index(legacy_index, str(tmp_path / "faiss.index"))
+    # Old ids were len(metadata) at insert time: "beta" was deleted as id 1
+    # and "gamma" later added as id 1 again
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump([
+            {"id": 0, "content": "alpha", "source": "a", "timestamp": "2024-01-01T00:00:00"},
+            {"id": 1, "content": "beta", "source": "b", "timestamp": "2024-01-01T00:00:00"},
+            {"id": 1, "content": "gamma", "source": "c", "timestamp": "2024-01-01T00:00:00"},
+        ], f)
+
+    store = make_store()
+
+    assert isinstance(store.index, faiss.IndexIDMap)
+    assert store.index.ntotal == 3
+    assert list(store.metadata.keys()) == [0, 1, 2]
+    assert [doc["content"] for doc in store.metadata.values()] == contents
+    assert faiss.vector_to_array(store.index.id_map).tolist() == [0, 1, 2]
+
+    # The migrated store is persisted and reloads unchanged
+    reloaded = make_store()
+    assert [doc["content"] for doc in reloaded.metadata.values()] == contents
+
+@pytest.mark.asyncio
+async def test_legacy_rows_still_match_their_documents(tmp_path, make_store):
+    """Test that search over a migrated store returns each row's own document"""
+    contents = ["alpha", "beta", "gamma"]
+    legacy_index = faiss.IndexFlatL2(FakeEncoder.DIM)
+    legacy_index.add(FakeEncoder().encode(contents))
+    faiss.write_index(legacy_index, str(tmp_path / "faiss.index"))
+    with open(tmp_path / "metadata.json", "w") as f:
+        json.dump([
+            {"id": i % 2, "content": content, "source": content, "timestamp": "2024-01-01T00:00:00"}
+            for i, content in enumerate(contents)
+        ], f)
+
+    store = make_store()
+
+    for content in contents:
+        context = await store.get_relevant_context(content, k=1)
+        assert context[0]["content"] == content
+    # New documents continue after the migrated ids
+    assert await store.add_document("delta", "d") == 3
+
+@pytest.mark.asyncio
+async def test_cached_context_is_a_copy(make_store):
+    """Test that mutating returned context doesn't change later lookups"""
+    store = make_store()
+    await store.add_document("alpha", "a")
+
+    first = await store.get_relevant_context("alpha", k=1)
+    first.clear()
+    second = await store.get_relevant_context("alpha", k=1)
+
+    assert [doc["content"] for doc in second] == ["alpha"]
+
+@pytest.mark.asyncio
+async def test_context_cache_is_invalidated_by_writes(make_store):
+    """Test that adds and deletes bump the generation so cached context is not reused"""
+    store = make_store()
+    await store.add_document("alpha", "a")
+    assert [doc["content"] for doc in await store.get_relevant_context("beta", k=2)] == ["alpha"]
+
+    beta_id = await store.add_document("beta", "b")
+    context = await store.get_relevant_context("beta", k=2)
+    assert [doc["content"] for doc in context] == ["beta", "alpha"]
+
+    await store.delete_document(beta_id)
+    context = await store.get_relevant_context("beta", k=2)
+    assert [doc["content"] for doc in context] == ["alpha"]
+
+@pytest.mark.asyncio
+async def test_delete_removes_only_that_documents_vector(make_store):
+    """Test that deleting by id keeps the other ids and never reuses the deleted one"""
+    store = make_store()
+    ids = await store.add_documents(["alpha", "beta", "gamma"], ["a", "b", "c"])
+    assert ids == [0, 1, 2]
+
+    await store.delete_document(1)
+
+    assert store.index.ntotal == 2
+    assert faiss.vector_to_array(store.index.id_map).tolist() == [0, 2]
+    assert await store.add_document("delta", "d") == 3
+    for content in ("alpha", "gamma", "delta"):
+        context = await store.get_relevant_context(content, k=1)
+        assert context[0]["content"] == content
+
+    # Ids and vectors survive a reload
+    reloaded = make_store()
+    assert list(reloaded.metadata.keys()) == [0, 2, 3]
+    assert faiss.vector_to_array(reloaded.index.id_map).tolist() == [0, 2, 3]
+
+@pytest.mark.asyncio
+async def test_clear_resets_documents_ids_and_cache(make_store):
+    """Test that clear() empties the store and restarts ids from zero"""
+    store = make_store()
+    await store.add_documents(["alpha", "beta"], ["a", "b"])
+    assert await store.get_relevant_context("alpha", k=1)
+
+    store.clear()
+
+    assert store.index.ntotal == 0
+    assert len(store.metadata) == 0
+    assert await store.get_relevant_context("alpha", k=1) == []
+    assert await store.add_document("gamma", "c") == 0
+    assert make_store().index.ntotal == 1
@@ -1,29 +1,21 @@
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
-from app.main import app
-from app.models.user import User
-from app.core.security import create_access_token
-import json
 
 @pytest.fixture
-def client():
-    return TestClient(app)
-
-@pytest.fixture
-def mock_user():
-    return User(
-        id=1,
-        username="testuser",
-        email="test@example.com",
-        hashed_password="hashed_password",
-        full_name="Test User"
-    )
+def ws(client, auth_headers):
+    # A fresh connection per test, past the "user joined" frame every client gets first
+    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
+        websocket.receive_json()
+        yield websocket
 
 @pytest.fixture
-def auth_headers(mock_user):
-    token = create_access_token({"sub": mock_user.username})
-    return {"Authorization": f"Bearer {token}"}
+def ws_pair(client, auth_headers):
+    # Two fresh connections; the second's join notice reaches both of them
+    with client.websocket_connect("/ws/chat", headers=auth_headers) as first:
+        first.receive_json()
+        with client.websocket_connect("/ws/chat", headers=auth_headers) as second:
+            second.receive_json()
+            first.receive_json()
+            yield first, second
 
 def test_websocket_connection(client, auth_headers):
     # Act
@@ -37,86 +29,71 @@ def test_websocket_connection_unauthorized(client):
         with client.websocket_connect("/ws/chat") as websocket:
             pass
 
-def test_websocket_send_message(client, auth_headers):
-    # Arrange
-    message = {
-        "type": "message",
-        "content": "Test message"
-    }
-
+@pytest.mark.parametrize(
+    "payload, expected, required_keys, error_text",
+    [
+        (
+            {"type": "message", "content": "Test message"},
+            {"type": "message", "content": "Test message"},
+            ("timestamp", "user_id"),
+            None
+        ),
+        (
+            {"type": "typing", "is_typing": True},
+            {"type": "typing", "is_typing": True},
+            ("user_id",),
+            None
+        ),
+        (
+            {"type": "invalid", "data": "Invalid format"},
+            {"type": "error"},
+            (),
+            "Invalid message format"
+        ),
+        (
+            "Invalid JSON",
+            {"type": "error"},
+            (),
+            "Invalid JSON"
+        ),
+    ],
+    ids=["message", "typing", "invalid_format", "invalid_json"]
+)
+def test_websocket_message_shapes(ws, payload, expected, required_keys, error_text):
     # Act
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        websocket.send_json(message)
-        response = websocket.receive_json()
+    if isinstance(payload, str):
+        ws.send_text(payload)
+    else:
+        ws.send_json(payload)
+    response = ws.receive_json()
 
     # Assert
-    assert response["type"] == "message"
-    assert response["content"] == "Test message"
-    assert "timestamp" in response
-    assert "user_id" in response
-
-def test_websocket_invalid_message_format(client, auth_headers):
-    # Arrange
-    invalid_message = {
-        "type": "invalid",
-        "data": "Invalid format"
-    }
-
-    # Act & Assert
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        websocket.send_json(invalid_message)
-        response = websocket.receive_json()
-        assert response["type"] == "error"
-        assert "Invalid message format" in response["message"]
-
-def test_websocket_connection_closed(client, auth_headers):
-    # Act
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        websocket.close()
-        assert not websocket.client_state.connected
-
-def test_websocket_multiple_messages(client, auth_headers):
+    for key, value in expected.items():
+        assert response[key] == value
+    for key in required_keys:
+        assert key in response
+    if error_text is not None:
+        assert error_text in response["message"]
+
+def test_websocket_multiple_messages(ws):
     # Arrange
     messages = [
         {"type": "message", "content": "First message"},
         {"type": "message", "content": "Second message"}
     ]
 
-    # Act
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        for message in messages:
-            websocket.send_json(message)
-            response = websocket.receive_json()
-            assert response["type"] == "message"
-            assert response["content"] == message["content"]
-
-def test_websocket_typing_indicator(client, auth_headers):
-    # Arrange
-    typing_message = {
-        "type": "typing",
-        "is_typing": True
-    }
+    # Act & Assert
+    for message in messages:
+        ws.send_json(message)
+        response = ws.receive_json()
+        assert response["type"] == "message"
+        assert response["content"] == message["content"]
 
+def test_websocket_connection_closed(client, auth_headers):
     # Act
     with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        websocket.send_json(typing_message)
-        response = websocket.receive_json()
-
-    # Assert
-    assert response["type"] == "typing"
-    assert response["is_typing"] is True
-    assert "user_id" in response
-
-def test_websocket_error_handling(client, auth_headers):
-    # Arrange
-    invalid_json = "Invalid JSON"
-
-    # Act & Assert
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket:
-        websocket.send_text(invalid_json)
-        response = websocket.receive_json()
-        assert response["type"] == "error"
-        assert "Invalid JSON" in response["message"]
+        websocket.close()
+        assert not websocket.client_state.connected
 
 def test_websocket_connection_timeout(client, auth_headers):
     # Act & Assert
@@ -125,19 +102,18 @@ def test_websocket_connection_timeout(client, auth_headers):
         websocket.close()
         assert not websocket.client_state.connected
 
-def test_websocket_broadcast_message(client, auth_headers):
+def test_websocket_broadcast_message(ws_pair):
     # Arrange
+    websocket1, websocket2 = ws_pair
     message = {
         "type": "message",
         "content": "Broadcast message"
     }
 
     # Act
-    with client.websocket_connect("/ws/chat", headers=auth_headers) as websocket1, \
-         client.websocket_connect("/ws/chat", headers=auth_headers) as websocket2:
-        websocket1.send_json(message)
-        response1 = websocket1.receive_json()
-        response2 = websocket2.receive_json()
+    websocket1.send_json(message)
+    response1 = websocket1.receive_json()
+    response2 = websocket2.receive_json()
 
     # Assert
     assert response1["content"] == message["content"]
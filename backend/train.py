@@ -1,55 +1,74 @@
 import torch
+import torch.utils.checkpoint
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
     Trainer,
-    DataCollatorForLanguageModeling
+    DataCollatorForLanguageModeling,
+    BitsAndBytesConfig
 )
-from datasets import Dataset
-import pandas as pd
+from datasets import Features, Value, load_dataset
+from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+import chardet
+import numpy as np
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import atexit
 from dotenv import load_dotenv
 import os
+import functools
+import importlib.util
 import shutil
 import time
 import sys
+from training_utils import ensure_pad_token, tokenize_texts
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('training.log')
-    ]
-)
+# Configure logging; records are queued and written by a background thread
+# so training steps never block on the log file. The queue is process-safe
+# so records from forked dataset.map workers reach the listener too
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler('training.log')]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = multiprocessing.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Zephyr chat template pieces: <|user|>\n{q}</s>\n<|assistant|>\n{a}</s>
+USER_PREFIX = "<|user|>\n"
+ASSISTANT_PREFIX = "</s>\n<|assistant|>\n"
+TURN_SUFFIX = "</s>"
+
+# Upper bound on tokens per example; the run truncates at the p99 length below it
+MAX_LENGTH = 512
+# Sample at least this many rows (or 1%) when estimating the p99 length
+LENGTH_SAMPLE_MIN = 1000
+
+# Checkpoint one decoder block in four (8 of Zephyr's 32)
+CHECKPOINT_EVERY = 4
+
 def prepare_dataset():
     """Load and prepare the dataset from CSV file."""
     try:
-        # Try different encodings
-        encodings = ['utf-8', 'latin1', 'cp1252', 'iso-8859-1']
-        df = None
-        
-        for encoding in encodings:
-            try:
-                df = pd.read_csv('Dataset_Banking_chatbot.csv', encoding=encoding)
-                logger.info(f"Successfully read CSV with {encoding} encoding")
-                break
-            except UnicodeDecodeError:
-                continue
-        
-        if df is None:
-            raise ValueError("Could not read CSV file with any encoding")
-        
-        # Convert to UTF-8 and save
-        os.makedirs('data', exist_ok=True)
-        df.to_csv('data/banking_chatbot_utf8.csv', index=False, encoding='utf-8')
+        # Sniff the encoding from the first 64 KB instead of re-parsing per guess
+        with open('Dataset_Banking_chatbot.csv', 'rb') as f:
+            encoding = chardet.detect(f.read(65536))['encoding'] or 'utf-8'
         
-        # Create dataset with proper formatting
-        dataset = Dataset.from_pandas(df)
+        # Arrow-backed and memory-mapped from the datasets cache, no pandas copy
+        dataset = load_dataset(
+            'csv',
+            data_files={'train': 'Dataset_Banking_chatbot.csv'},
+            encoding=encoding,
+            usecols=['Query', 'Response'],
+            features=Features({'Query': Value('string'), 'Response': Value('string')})
+        )['train']
+        logger.info(f"Successfully read CSV with {encoding} encoding")
         
         # Split into train and validation
         split_dataset = dataset.train_test_split(test_size=0.1, seed=42)
@@ -59,35 +78,50 @@ def prepare_dataset():
         logger.error(f"Error preparing dataset: {str(e)}")
         raise
 
-def tokenize_function(examples, tokenizer):
+def tokenize_function(examples, tokenizer, max_length=MAX_LENGTH):
     """Tokenize the examples with proper formatting."""
     try:
-        # Format the conversation
-        formatted_examples = []
-        for q, a in zip(examples['Query'], examples['Response']):
-            # Create a structured conversation format
-            conversation = f"""<|user|>
-{q}</s>
-<|assistant|>
-{a}</s>"""
-            formatted_examples.append(conversation)
-        
-        # Tokenize with proper padding and truncation
-        tokenized = tokenizer(
-            formatted_examples,
-            padding="max_length",
-            truncation=True,
-            max_length=512,  # Increased for Zephyr's context window
-            return_tensors="pt"
-        )
+        # Format the conversation in Zephyr's chat template
+        formatted_examples = [
+            USER_PREFIX + q + ASSISTANT_PREFIX + a + TURN_SUFFIX
+            for q, a in zip(examples['Query'], examples['Response'])
+        ]
         
-        return tokenized
+        return tokenize_texts(tokenizer, formatted_examples, max_length)
     except Exception as e:
         logger.error(f"Error in tokenization: {str(e)}")
         raise
 
+def estimate_max_length(dataset, tokenizer, percentile=99):
+    """Return the given percentile of tokenized lengths over a sample.
+
+    Rounded up to a multiple of 8 for tensor cores and capped at MAX_LENGTH.
+    """
+    sample_size = min(len(dataset), max(LENGTH_SAMPLE_MIN, len(dataset) // 100))
+    sample = dataset.shuffle(seed=42).select(range(sample_size))
+    lengths = tokenize_function(sample[:], tokenizer)["length"]
+    length = int(np.ceil(np.percentile(lengths, percentile)))
+    return min(MAX_LENGTH, -(-length // 8) * 8)
+
+def checkpoint_every_nth_layer(layers, every):
+    """Recompute every `every`-th decoder block in the backward pass.
+
+    The other blocks keep their activations, trading a little memory for far
+    less recomputation than checkpointing all of them.
+    """
+    for layer in layers[::every]:
+        # Non-reentrant checkpointing recomputes correctly under FlashAttention-2
+        layer.forward = functools.partial(
+            torch.utils.checkpoint.checkpoint,
+            layer.forward,
+            use_reentrant=False
+        )
+
 def save_model_safely(model, tokenizer, save_dir, max_retries=3):
-    """Safely save the model and tokenizer with retry logic."""
+    """Safely save the model and tokenizer with retry logic.
+
+    For a PEFT model only the LoRA adapter weights are written.
+    """
     temp_dir = f"{save_dir}_temp_{int(time.time())}"
     final_dir = save_dir
     
@@ -98,25 +132,40 @@ def save_model_safely(model, tokenizer, save_dir, max_retries=3):
                 shutil.rmtree(temp_dir)
             os.makedirs(temp_dir, exist_ok=True)
             
-            # Save model and tokenizer to temp directory
-            model.save_pretrained(temp_dir)
+            # Save model and tokenizer to temp directory as safetensors; a PEFT
+            # model writes only its adapter, a full model is sharded
+            if hasattr(model, "peft_config"):
+                model.save_pretrained(temp_dir, safe_serialization=True)
+            else:
+                model.save_pretrained(temp_dir, safe_serialization=True, max_shard_size="2GB")
             tokenizer.save_pretrained(temp_dir)
-            
-            # If successful, move to final location
-            if os.path.exists(final_dir):
-                shutil.rmtree(final_dir)
-            shutil.move(temp_dir, final_dir)
-            
-            logger.info(f"Successfully saved model to {final_dir}")
-            return True
+            break
             
         except Exception as e:
             logger.warning(f"Attempt {attempt + 1} failed to save model: {str(e)}")
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
             time.sleep(1)  # Wait before retrying
+    else:
+        raise RuntimeError(f"Failed to save model after {max_retries} attempts")
     
-    raise RuntimeError(f"Failed to save model after {max_retries} attempts")
+    # Swap the finished directory into place with renames; the temp directory
+    # is a sibling, so both are on the same filesystem. The previous model is
+    # moved aside rather than deleted first, so a failure never leaves neither
+    backup_dir = f"{save_dir}_old_{int(time.time())}"
+    if os.path.exists(final_dir):
+        os.replace(final_dir, backup_dir)
+    try:
+        os.replace(temp_dir, final_dir)
+    except OSError:
+        if os.path.exists(backup_dir):
+            os.replace(backup_dir, final_dir)
+        raise
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir)
+    
+    logger.info(f"Successfully saved model to {final_dir}")
+    return True
 
 def main():
     """Main training function."""
@@ -128,62 +177,121 @@ def main():
         device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Using device: {device}")
         
+        # bf16 on Ampere and newer needs no loss scaling; fp16 on older GPUs
+        use_bf16 = device == "cuda" and torch.cuda.is_bf16_supported()
+        compute_dtype = torch.bfloat16 if use_bf16 else torch.float16
+        
         # Initialize model and tokenizer
         model_name = "HuggingFaceH4/zephyr-7b-beta"
         logger.info(f"Loading model and tokenizer from {model_name}")
         
-        # Load model with memory optimizations
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            device_map="auto",
-            trust_remote_code=True,
-            low_cpu_mem_usage=True,
-            use_cache=False  # Disable KV cache for training
-        )
+        # QLoRA on GPU: keep the frozen base weights in 4-bit NF4 (double
+        # quantized) and compute in half precision; only the LoRA adapters get gradients
+        if device == "cuda":
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                quantization_config=BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_compute_dtype=compute_dtype
+                ),
+                torch_dtype=compute_dtype,
+                # Fused tiled attention kernels when flash-attn is installed
+                use_flash_attention_2=importlib.util.find_spec("flash_attn") is not None,
+                device_map="auto",
+                trust_remote_code=True,
+                low_cpu_mem_usage=True,
+                use_cache=False  # Disable KV cache for training
+            )
+            model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=False)
+            checkpoint_every_nth_layer(model.model.layers, CHECKPOINT_EVERY)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.float32,
+                device_map="auto",
+                trust_remote_code=True,
+                low_cpu_mem_usage=True,
+                use_cache=False  # Disable KV cache for training
+            )
+        
+        # Train low-rank adapters on the query/value projections only
+        model = get_peft_model(model, LoraConfig(
+            r=16,
+            lora_alpha=32,
+            lora_dropout=0.05,
+            target_modules=["q_proj", "v_proj"],
+            task_type="CAUSAL_LM"
+        ))
+        model.print_trainable_parameters()
         
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(
             model_name,
+            use_fast=True,
             trust_remote_code=True
         )
+        ensure_pad_token(tokenizer)
         
         # Prepare dataset
         logger.info("Preparing dataset...")
         dataset = prepare_dataset()
         
+        # Truncate at the p99 length rather than the full 512 tokens
+        max_length = estimate_max_length(dataset["train"], tokenizer)
+        logger.info(f"Using max_length={max_length} (p99 of sampled lengths)")
+        
         # Tokenize datasets
         logger.info("Tokenizing datasets...")
         def tokenize(examples):
-            return tokenize_function(examples, tokenizer)
+            return tokenize_function(examples, tokenizer, max_length)
         
+        # Cached by fingerprint next to the CSV's Arrow file; later runs
+        # memory-map the tokenized splits instead of tokenizing again
         tokenized_datasets = dataset.map(
             tokenize,
             batched=True,
-            remove_columns=dataset["train"].column_names
+            batch_size=1000,
+            num_proc=os.cpu_count(),
+            remove_columns=dataset["train"].column_names,
+            load_from_cache_file=True
         )
         
         # Training arguments with memory optimizations
         training_args = TrainingArguments(
             output_dir="./finetuned_model",
             num_train_epochs=2,
-            per_device_train_batch_size=1,
-            gradient_accumulation_steps=16,
+            # QLoRA + FlashAttention-2 + dynamic padding leave room for real
+            # batches; global batch stays 16
+            per_device_train_batch_size=8,
+            per_device_eval_batch_size=8,
+            gradient_accumulation_steps=2,
             learning_rate=2e-5,
             weight_decay=0.01,
             warmup_steps=50,
             logging_steps=5,
             save_steps=50,
+            # Keep only the latest and best checkpoints, as safetensors
+            save_total_limit=2,
+            save_safetensors=True,
             eval_steps=50,
             evaluation_strategy="steps",
             load_best_model_at_end=True,
             push_to_hub=False,
-            fp16=True if device == "cuda" else False,
-            gradient_checkpointing=True if device == "cuda" else False,
-            optim="adamw_torch",
+            bf16=use_bf16,
+            fp16=device == "cuda" and not use_bf16,
+            # Selective checkpointing is applied to the decoder blocks directly
+            gradient_checkpointing=False,
+            # 8-bit optimizer state, paged to host memory during checkpoint-recompute spikes
+            optim="paged_adamw_8bit" if device == "cuda" else "adamw_torch",
             report_to="none",
             remove_unused_columns=True,
             dataloader_pin_memory=True if device == "cuda" else False,
+            # Collate and pin the next batches in worker processes during the step
+            dataloader_num_workers=max(1, (os.cpu_count() or 1) // 2),
+            group_by_length=True,
+            length_column_name="length",
             max_grad_norm=1.0,
             lr_scheduler_type="cosine"
         )
@@ -197,7 +305,8 @@ def main():
             eval_dataset=tokenized_datasets["test"],
             data_collator=DataCollatorForLanguageModeling(
                 tokenizer=tokenizer,
-                mlm=False
+                mlm=False,
+                pad_to_multiple_of=8
             )
         )
         
@@ -205,8 +314,8 @@ def main():
         logger.info("Starting training...")
         trainer.train()
         
-        # Save the model and tokenizer safely
-        logger.info("Saving model and tokenizer...")
+        # Save the LoRA adapter and tokenizer safely
+        logger.info("Saving adapter and tokenizer...")
         save_model_safely(model, tokenizer, "./finetuned_model")
         
         logger.info("Training completed successfully")
@@ -0,0 +1,24 @@
+"""Tokenization helpers shared by train.py and finetune.py."""
+from typing import List
+
+def ensure_pad_token(tokenizer):
+    """Pad with the EOS token when the tokenizer defines no pad token."""
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def tokenize_texts(tokenizer, texts: List[str], max_length: int):
+    """Tokenize texts for causal LM training.
+
+    Sequences are truncated but left unpadded, since the data collator pads
+    each batch to its longest sequence. A "length" column lets the trainer
+    group similar lengths together.
+    """
+    tokenized = tokenizer(
+        texts,
+        padding=False,
+        truncation=True,
+        max_length=max_length
+    )
+    tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
+    return tokenized